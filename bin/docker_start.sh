@@ -17,6 +17,8 @@ export PYTHONPATH=$DJANGODIR:$PYTHONPATH
 
 python manage.py makemigrations && \
   python manage.py migrate && \
+  python manage.py reconcile_comment_counts && \
+  python manage.py render_articles && \
   python manage.py collectstatic --noinput  && \
   python manage.py compress --force && \
   python manage.py build_index && \
@@ -1,7 +1,7 @@
 import logging
 from datetime import datetime
 
-from djangoblog.utils import cache, get_blog_setting
+from djangoblog.utils import get_blog_setting, local_cache
 from .models import Category, Article
 
 logger = logging.getLogger(__name__)
@@ -9,7 +9,8 @@ logger = logging.getLogger(__name__)
 
 def seo_processor(requests):
     key = 'seo_processor'
-    value = cache.get(key)
+    namespaces = ['blogsettings', 'category', 'article']
+    value = local_cache.get(key, namespaces)
     if not value:
         logger.info('set processor cache.')
         setting = get_blog_setting()
@@ -32,5 +33,6 @@ def seo_processor(requests):
             "BEIAN_CODE_GONGAN": setting.gongan_beiancode,
             "SHOW_GONGAN_CODE": setting.show_gongan_code,
             "CURRENT_YEAR": datetime.now().year}
-        cache.set(key, value, 60**2 * 10)
+        local_cache.set(
+            key, value, 60**2 * 10, namespaces=namespaces)
     return value
@@ -0,0 +1,241 @@
+"""
+由已发布文章预先计算的索引, 文章发布、撤回或删除时更新.
+索引丢失或过期时按需从数据库重建, 重建时只读取需要的字段
+"""
+import bisect
+import datetime
+import logging
+import threading
+from collections import namedtuple
+
+from django.db import transaction
+from django.db.models import Q
+
+from djangoblog.utils import bump_namespace, cache, get_namespace_versions, local_cache
+
+logger = logging.getLogger(__name__)
+
+# 归档索引按月分桶: 月份列表[(year, month)]按时间倒序,
+# 每月的文章[(pub_time, id, title, url)]按发布时间倒序, 各自单独缓存.
+# 所有key都带archive命名空间的版本号, 版本号增加后整个索引作废
+ARCHIVE_NAMESPACE = 'archive'
+ARCHIVE_MONTHS_KEY = 'archive_months'
+ARCHIVE_MONTH_KEY = 'archive_month_{year}_{month}'
+ARCHIVE_INDEX_TIMEOUT = 60 * 60 * 24
+INDEX_LOCK_KEY = 'archive_index_lock'
+INDEX_LOCK_TIMEOUT = 10
+
+
+def _article_url(pk, created_time):
+    from blog.models import Article
+    return Article(id=pk, created_time=created_time).get_absolute_url()
+
+
+def _archive_entry(pk, title, pub_time, created_time):
+    return (pub_time, pk, title, _article_url(pk, created_time))
+
+
+def _month(pub_time):
+    return pub_time.year, pub_time.month
+
+
+def _archive_version():
+    return get_namespace_versions([ARCHIVE_NAMESPACE])[ARCHIVE_NAMESPACE]
+
+
+def _archive_key(key, version):
+    return '{key}_v{version}'.format(key=key, version=version)
+
+
+def _month_key(month, version):
+    return _archive_key(ARCHIVE_MONTH_KEY.format(year=month[0], month=month[1]), version)
+
+
+def _query_buckets(months=None):
+    """
+    从数据库读取已发布文章并按月分组
+    :param months: 只读取这些月份, None时读取全部
+    """
+    from blog.models import Article
+    articles = Article.objects.filter(status='p')
+    if months is not None:
+        ranges = Q()
+        for year, month in months:
+            start = datetime.datetime(year, month, 1, tzinfo=datetime.timezone.utc)
+            end = datetime.datetime(
+                year + month // 12, month % 12 + 1, 1, tzinfo=datetime.timezone.utc)
+            ranges |= Q(pub_time__gte=start, pub_time__lt=end)
+        articles = articles.filter(ranges)
+    rows = articles.order_by('-pub_time', '-id').values_list(
+        'id', 'title', 'pub_time', 'created_time')
+    buckets = {month: [] for month in months or []}
+    for row in rows:
+        entry = _archive_entry(*row)
+        buckets.setdefault(_month(entry[0]), []).append(entry)
+    return buckets
+
+
+def build_archive_index(version=None):
+    if version is None:
+        version = _archive_version()
+    buckets = _query_buckets()
+    months = sorted(buckets, reverse=True)
+    # 用add写入, 不覆盖重建期间已提交的增量更新
+    for month in months:
+        cache.add(_month_key(month, version), buckets[month], ARCHIVE_INDEX_TIMEOUT)
+    cache.add(_archive_key(ARCHIVE_MONTHS_KEY, version), months, ARCHIVE_INDEX_TIMEOUT)
+    logger.info('build archive index: %d months' % len(months))
+    return [(month, buckets[month]) for month in months]
+
+
+def get_archive_index():
+    """
+    :return: [((year, month), [(pub_time, id, title, url)])], 按时间倒序
+    """
+    version = _archive_version()
+    months = cache.get(_archive_key(ARCHIVE_MONTHS_KEY, version))
+    if months is None:
+        return build_archive_index(version)
+    keys = {_month_key(month, version): month for month in months}
+    buckets = {keys[k]: v for k, v in cache.get_many(list(keys)).items()}
+    missing = [month for month in months if month not in buckets]
+    if missing:
+        # 单个月份被淘汰时只重建该月份
+        rebuilt = _query_buckets(missing)
+        for month in missing:
+            cache.add(_month_key(month, version), rebuilt[month], ARCHIVE_INDEX_TIMEOUT)
+        buckets.update(rebuilt)
+    return [(month, buckets[month]) for month in months if buckets[month]]
+
+
+def get_archive_months():
+    """
+    按年月分组的归档
+    :return: [(year, [(month, [(id, title, url)])])]
+    """
+    years = []
+    for (year, month), entries in get_archive_index():
+        if not years or years[-1][0] != year:
+            years.append((year, []))
+        years[-1][1].append((month, [(pk, title, url) for _, pk, title, url in entries]))
+    return years
+
+
+def update_archive_index(article, deleted=False):
+    """
+    文章保存或删除后, 在事务提交后更新所在月份及原月份的归档索引
+    """
+    entry = None
+    if not deleted and article.status == 'p':
+        entry = _archive_entry(
+            article.pk, article.title, article.pub_time, article.created_time)
+    months = {_month(article.pub_time)}
+    loaded_pub_time = getattr(article, '_loaded_pub_time', None)
+    if loaded_pub_time:
+        months.add(_month(loaded_pub_time))
+    article._loaded_pub_time = article.pub_time
+    pk = article.pk
+    transaction.on_commit(lambda: _update_archive_months(pk, entry, months))
+
+
+def _update_archive_months(pk, entry, months):
+    # 先取版本号再加锁, 等待锁的进程增加版本号后, 这里写入的旧版本key随之作废
+    version = _archive_version()
+    if not cache.add(INDEX_LOCK_KEY, 1, INDEX_LOCK_TIMEOUT):
+        # 其他进程正在更新, 使整个索引作废, 读取时重建
+        bump_namespace(ARCHIVE_NAMESPACE)
+        return
+    try:
+        months_key = _archive_key(ARCHIVE_MONTHS_KEY, version)
+        index_months = cache.get(months_key)
+        if index_months is None:
+            return
+        keys = {_month_key(month, version): month for month in months}
+        found = cache.get_many(list(keys))
+        updates = {}
+        for key, month in keys.items():
+            if month in index_months:
+                if key not in found:
+                    # 该月份读取时从数据库重建
+                    continue
+                bucket = [e for e in found[key] if e[1] != pk]
+            else:
+                bucket = []
+            if entry and _month(entry[0]) == month:
+                position = next(
+                    (i for i, e in enumerate(bucket) if (e[0], e[1]) < (entry[0], entry[1])),
+                    len(bucket))
+                bucket.insert(position, entry)
+            updates[key] = bucket
+        # 没有文章的月份从列表中移除
+        new_months = set(index_months)
+        for key, bucket in updates.items():
+            if bucket:
+                new_months.add(keys[key])
+            else:
+                new_months.discard(keys[key])
+        new_months = sorted(new_months, reverse=True)
+        cache.set_many(updates, ARCHIVE_INDEX_TIMEOUT)
+        if new_months != index_months:
+            cache.set(months_key, new_months, ARCHIVE_INDEX_TIMEOUT)
+    finally:
+        cache.delete(INDEX_LOCK_KEY)
+
+
+ArticleLink = namedtuple('ArticleLink', ['id', 'title', 'url'])
+
+
+class NeighborIndex:
+    """
+    上下篇索引, 已发布文章按列表页顺序的逆序排列, 即越靠后越新, 按文章的排序值二分查找.
+    整个索引保存在进程内, 文章保存或删除后命名空间版本号变化, 下次查找时重新读取
+    """
+
+    def __init__(self, namespace='article'):
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._version = None
+        self._keys = []
+        self._items = []
+
+    @staticmethod
+    def _key(article_order, pub_time, pk):
+        return (article_order, pub_time.timestamp(), pk)
+
+    def _get_index(self):
+        version = local_cache.namespace_versions([self.namespace])
+        if version != self._version:
+            with self._lock:
+                if version != self._version:
+                    from blog.models import Article
+                    rows = Article.objects.filter(status='p').order_by(
+                        'article_order', 'pub_time', 'id').values_list(
+                        'id', 'title', 'article_order', 'pub_time', 'created_time')
+                    keys = []
+                    items = []
+                    for pk, title, article_order, pub_time, created_time in rows:
+                        keys.append(self._key(article_order, pub_time, pk))
+                        items.append(ArticleLink(pk, title, _article_url(pk, created_time)))
+                    self._keys, self._items = keys, items
+                    self._version = version
+        return self._keys, self._items
+
+    def neighbors(self, article):
+        """
+        :return: (上一篇, 下一篇), 即更早与更新的文章, 不存在时为None
+        """
+        keys, items = self._get_index()
+        key = self._key(article.article_order, article.pub_time, article.pk)
+        position = bisect.bisect_left(keys, key)
+        if position >= len(keys) or keys[position] != key:
+            return None, None
+        prev_item = items[position - 1] if position > 0 else None
+        next_item = items[position + 1] if position + 1 < len(keys) else None
+        return prev_item, next_item
+
+
+neighbor_index = NeighborIndex()
+
+
+def get_neighbors(article):
+    return neighbor_index.neighbors(article)
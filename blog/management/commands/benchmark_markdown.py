@@ -0,0 +1,76 @@
+import time
+from contextlib import contextmanager
+
+import pygments
+from django.core.management.base import BaseCommand
+from markdown.extensions import codehilite
+
+from djangoblog.utils import CommonMarkdown
+
+SHORT_COMMENT = 'Nice post, **thanks**! See [the docs](https://docs.djangoproject.com/).'
+
+ARTICLE_SECTION = '''
+## Section {index}
+
+Some text with *emphasis*, `inline code` and a [link](https://www.lylinux.net/).
+
+| name | value |
+| ---- | ----- |
+| a    | 1     |
+
+```python
+import os
+
+
+def walk(path):
+    for root, dirs, files in os.walk(path):
+        print(root, len(files))
+```
+'''
+
+
+class Command(BaseCommand):
+    help = 'benchmark markdown conversions per second, fresh converter vs pooled converter'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--number', type=int, default=200, help='conversions per case')
+        parser.add_argument('--sections', type=int, default=30, help='sections of the long article')
+
+    def run(self, convert, value, number):
+        start = time.perf_counter()
+        for _ in range(number):
+            convert(value)
+        return number / (time.perf_counter() - start)
+
+    @staticmethod
+    @contextmanager
+    def uncached_highlight():
+        """
+        新建转换器的基准不使用代码高亮缓存
+        """
+        cached = codehilite.highlight
+        codehilite.highlight = pygments.highlight
+        try:
+            yield
+        finally:
+            codehilite.highlight = cached
+
+    def handle(self, *args, **options):
+        number = options['number']
+        article = '# Title\n' + ''.join(
+            ARTICLE_SECTION.format(index=i) for i in range(options['sections']))
+
+        def fresh(value):
+            return CommonMarkdown._create_markdown().convert(value)
+
+        cases = [('short comment', SHORT_COMMENT, number),
+                 ('long article', article, max(1, number // 10))]
+        for name, value, n in cases:
+            # 预热, 避免pygments首次加载lexer的开销计入结果
+            with self.uncached_highlight():
+                fresh(value)
+                before = self.run(fresh, value, n)
+            CommonMarkdown.get_markdown(value)
+            after = self.run(CommonMarkdown.get_markdown, value, n)
+            self.stdout.write('{name}: fresh {before:.1f}/s, pooled {after:.1f}/s ({ratio:.2f}x)'.format(
+                name=name, before=before, after=after, ratio=after / before))
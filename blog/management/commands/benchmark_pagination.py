@@ -0,0 +1,61 @@
+import time
+
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils.timezone import now, timedelta
+
+from accounts.models import BlogUser
+from blog.models import Article, Category
+from blog.paginator import KeysetPaginator
+from djangoblog.utils import bump_namespace
+
+
+class Command(BaseCommand):
+    help = 'benchmark offset vs keyset pagination of article lists, test data is rolled back'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=100000, help='articles to create')
+        parser.add_argument('--page', type=int, default=5000, help='deep page to compare with page 1')
+        parser.add_argument('--per-page', type=int, default=settings.PAGINATE_BY)
+
+    def measure(self, paginator, number):
+        start = time.perf_counter()
+        page = paginator.page(number)
+        list(page.object_list)
+        page.has_next()
+        return (time.perf_counter() - start) * 1000
+
+    def handle(self, *args, **options):
+        count = options['count']
+        per_page = options['per_page']
+        deep = min(options['page'], max(1, count // per_page))
+        with transaction.atomic():
+            user = BlogUser.objects.create(username='benchmark_pagination', email='benchmark@example.com')
+            category = Category.objects.create(name='benchmark_pagination')
+            base = now()
+            Article.objects.bulk_create([Article(
+                title='benchmark pagination %d' % i,
+                body='benchmark',
+                author=user,
+                category=category,
+                pub_time=base - timedelta(minutes=i)) for i in range(count)], batch_size=1000)
+            queryset = Article.objects.filter(type='a', status='p')
+            keyset = KeysetPaginator(queryset, per_page, namespaces=['benchmark_pagination'])
+
+            for name, paginator in [
+                    ('offset', Paginator(queryset.order_by(*KeysetPaginator.ordering), per_page)),
+                    ('keyset', keyset)]:
+                first = self.measure(paginator, 1)
+                cold = self.measure(paginator, deep)
+                # 再次访问及顺序翻页时已有锚点
+                warm = self.measure(paginator, deep)
+                following = self.measure(paginator, deep + 1) if deep < count // per_page else 0
+                self.stdout.write(
+                    '{name}: page 1 {first:.2f}ms, page {deep} {cold:.2f}ms, '
+                    'again {warm:.2f}ms, page {next} {following:.2f}ms'.format(
+                        name=name, first=first, deep=deep, cold=cold, warm=warm,
+                        next=deep + 1, following=following))
+            transaction.set_rollback(True)
+        bump_namespace('benchmark_pagination')
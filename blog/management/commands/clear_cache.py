@@ -1,6 +1,6 @@
 from django.core.management.base import BaseCommand
 
-from djangoblog.utils import cache
+from djangoblog.utils import cache, local_cache
 
 
 class Command(BaseCommand):
@@ -8,4 +8,5 @@ class Command(BaseCommand):
 
     def handle(self, *args, **options):
         cache.clear()
+        local_cache.clear()
         self.stdout.write(self.style.SUCCESS('Cleared cache\n'))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from blog.view_counter import flush_views
+
+
+class Command(BaseCommand):
+    help = 'write buffered article views to the database'
+
+    def handle(self, *args, **options):
+        deltas = flush_views()
+        self.stdout.write(self.style.SUCCESS(
+            'flushed %d views of %d articles' % (sum(deltas.values()), len(deltas))))
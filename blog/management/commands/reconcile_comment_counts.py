@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from blog.models import Article
+
+
+class Command(BaseCommand):
+    help = 'recompute enabled comment counts of all articles'
+
+    def handle(self, *args, **options):
+        before = dict(Article.objects.values_list('id', 'comment_count'))
+        Article.update_comment_counts()
+        after = dict(Article.objects.values_list('id', 'comment_count'))
+        changed = [pk for pk, count in after.items() if before.get(pk) != count]
+        self.stdout.write(self.style.SUCCESS(
+            'reconciled %d articles, %d changed' % (len(after), len(changed))))
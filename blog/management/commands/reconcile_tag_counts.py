@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from blog.models import Tag
+from djangoblog.utils import bump_namespace, delete_sidebar_cache
+
+
+class Command(BaseCommand):
+    help = 'recompute published article counts of all tags'
+
+    def handle(self, *args, **options):
+        before = dict(Tag.objects.values_list('id', 'article_count'))
+        Tag.update_article_counts()
+        after = dict(Tag.objects.values_list('id', 'article_count'))
+        changed = [pk for pk, count in after.items() if before.get(pk) != count]
+        if changed:
+            bump_namespace('tag')
+            delete_sidebar_cache()
+        self.stdout.write(self.style.SUCCESS(
+            'reconciled %d tags, %d changed' % (len(after), len(changed))))
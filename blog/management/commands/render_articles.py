@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from blog.models import Article
+
+
+class Command(BaseCommand):
+    help = 'render article markdown and save html, toc and excerpt'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help='render all articles even if the body is unchanged')
+
+    def handle(self, *args, **options):
+        force = options['force']
+        count = 0
+        for article in Article.objects.all():
+            if article.render_body(force=force):
+                Article.objects.filter(pk=article.pk).update(
+                    **{f: getattr(article, f) for f in Article.RENDERED_FIELDS})
+                count += 1
+        self.stdout.write(self.style.SUCCESS('rendered %d articles' % count))
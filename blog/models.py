@@ -1,17 +1,22 @@
+import html
 import logging
 from abc import abstractmethod
 
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from django.urls import reverse
+from django.utils.html import strip_tags
 from django.utils.timezone import now
 from django.utils.translation import gettext_lazy as _
 from mdeditor.fields import MDTextField
 from uuslug import slugify
 
-from djangoblog.utils import cache_decorator, cache
-from djangoblog.utils import get_current_site
+from blog.indexes import get_neighbors
+from djangoblog.utils import bump_namespace, cache_decorator, cache, make_namespace_key
+from djangoblog.utils import get_current_site, get_sha256, CommonMarkdown
 
 logger = logging.getLogger(__name__)
 
@@ -91,6 +96,8 @@ class Article(BaseModel):
     )
     type = models.CharField('Type', max_length=1, choices=TYPE, default='a')
     views = models.PositiveIntegerField('Views', default=0)
+    # 已启用的评论数, 评论增删或启用状态变化时重新统计
+    comment_count = models.PositiveIntegerField('Comment count', default=0, editable=False)
     author = models.ForeignKey(
             settings.AUTH_USER_MODEL,
             verbose_name='Authors',
@@ -110,6 +117,16 @@ class Article(BaseModel):
             null=False
     )
     tags = models.ManyToManyField('Tag', verbose_name='Tag', blank=True)
+    body_html = models.TextField('Body html', blank=True, default='', editable=False)
+    toc_html = models.TextField('TOC html', blank=True, default='', editable=False)
+    excerpt = models.TextField('Excerpt', blank=True, default='', editable=False)
+    summary_html = models.TextField('Summary html', blank=True, default='', editable=False)
+    summary_length = models.IntegerField('Summary length', default=0, editable=False)
+    body_hash = models.CharField('Body hash', max_length=64, blank=True, default='', editable=False)
+    
+    # 由正文生成并持久化的字段
+    SUMMARY_FIELDS = ('summary_html', 'summary_length', 'excerpt')
+    RENDERED_FIELDS = ('body_html', 'toc_html', 'body_hash') + SUMMARY_FIELDS
     
     def body_to_string(self):
         return self.body
@@ -119,6 +136,10 @@ class Article(BaseModel):
     
     class Meta:
         ordering = ['-article_order', '-pub_time']
+        # 列表页按该顺序分页
+        indexes = [models.Index(
+            fields=['-article_order', '-pub_time', '-id'],
+            name='article_list_order_idx')]
         verbose_name = "Articles"
         verbose_name_plural = verbose_name
         get_latest_by = 'id'
@@ -131,45 +152,122 @@ class Article(BaseModel):
             'day': self.created_time.day
         })
     
-    @cache_decorator(60**2 * 10)
+    @cache_decorator(60**2 * 10, namespaces=['category'])
     def get_category_tree(self):
         tree = self.category.get_category_tree()
         return list(map(lambda c: (c.name, c.get_absolute_url()), tree))
     
+    def render_body(self, force=False):
+        """
+        Render body to html, toc, summary and plain text excerpt.
+        Skipped when the body hash is unchanged.
+        :return: whether the rendered fields changed
+        """
+        body_hash = get_sha256(self.body)
+        if not force and body_hash == self.body_hash:
+            return False
+        body, toc = CommonMarkdown.get_markdown_with_toc(self.body)
+        self.body_html = body
+        self.toc_html = toc
+        self.body_hash = body_hash
+        self.render_summary()
+        return True
+    
+    def render_summary(self, length=None):
+        """
+        Render the summary from the leading blocks of the body.
+        """
+        if length is None:
+            from djangoblog.utils import get_blog_setting
+            length = get_blog_setting().article_sub_length
+        self.set_summary(CommonMarkdown.get_markdown_summary(self.body, length), length)
+    
+    def set_summary(self, summary, length):
+        self.summary_html = summary
+        self.summary_length = length
+        # 纯文本, 模板输出时再转义
+        self.excerpt = html.unescape(strip_tags(summary)).strip()
+    
     def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'body' in update_fields:
+            if self.render_body() and update_fields is not None:
+                kwargs['update_fields'] = list(update_fields) + list(self.RENDERED_FIELDS)
         super().save(*args, **kwargs)
     
-    def viewed(self):
-        self.views += 1
-        self.save(update_fields=['views'])
+    def get_comment_count(self):
+        return self.comment_count
+
+    @classmethod
+    def update_comment_counts(cls, article_ids=None):
+        """
+        重新统计文章已启用的评论数, 一条UPDATE完成
+        :param article_ids: 需要统计的文章, None表示全部
+        """
+        from comments.models import Comment
+        counts = Comment.objects.filter(
+            article_id=OuterRef('pk'), is_enable=True).order_by().values(
+            'article_id').annotate(count=Count('id')).values('count')
+        articles = cls.objects.all()
+        if article_ids is not None:
+            article_ids = list(article_ids)
+            if not article_ids:
+                return 0
+            articles = articles.filter(pk__in=article_ids)
+        return articles.update(comment_count=Coalesce(Subquery(counts), 0))
+
+    def viewed(self, request=None):
+        from blog.view_counter import count_view, record_view
+        # 阅读数定时批量写入数据库, 这里只加上尚未写入的部分用于显示
+        if request is None:
+            self.views += record_view(self.pk)
+        else:
+            self.views += count_view(self.pk, request)
     
     def comment_list(self):
-        cache_key = 'article_comments_{id}'.format(id=self.id)
+        cache_key = make_namespace_key(
+                [self.comments_namespace()],
+                'article_comments_{id}'.format(id=self.id)
+        )
         value = cache.get(cache_key)
         if value:
             logger.info('get article comments:{id}'.format(id=self.id))
             return value
         else:
-            comments = self.comment_set.filter(is_enable=True)
+            comments = list(self.comment_set.filter(is_enable=True).select_related(
+                'author', 'parent_comment__author'))
             cache.set(cache_key, comments, 60 * 100)
             logger.info('set article comments:{id}'.format(id=self.id))
             return comments
     
+    def comments_namespace(self):
+        return 'article_comments:{id}'.format(id=self.id)
+    
     def get_admin_url(self):
         info = (self._meta.app_label, self._meta.model_name)
         return reverse('admin:%s_%s_change' % info, args=(self.pk,))
     
-    @cache_decorator(expiration=60 * 100)
+    # 决定文章在哪些列表中及其顺序的字段, 变化时列表的分页锚点失效
+    LIST_FIELDS = ('status', 'type', 'article_order', 'pub_time', 'category_id', 'author_id')
+
+    def list_key(self):
+        return tuple(self.__dict__.get(f) for f in self.LIST_FIELDS)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # 保存时用于从原月份的归档索引中移除, 及判断列表字段是否变化
+        instance._loaded_pub_time = instance.__dict__.get('pub_time')
+        instance._loaded_list_key = instance.list_key()
+        return instance
+
     def next_article(self):
         # 下一篇
-        return Article.objects.filter(
-                id__gt=self.id, status='p'
-        ).order_by('id').first()
-    
-    @cache_decorator(expiration=60 * 100)
+        return get_neighbors(self)[1]
+
     def prev_article(self):
         # 前一篇
-        return Article.objects.filter(id__lt=self.id, status='p').first()
+        return get_neighbors(self)[0]
 
 
 class Category(BaseModel):
@@ -184,6 +282,8 @@ class Category(BaseModel):
     )
     slug = models.SlugField(default='no-slug', max_length=60, blank=True)
     index = models.IntegerField(default=0, verbose_name="Index sorting")
+    # 从顶级分类到当前分类的id路径, 如'/1/5/9/', 子分类按前缀查询
+    path = models.CharField('Path', max_length=255, blank=True, default='', db_index=True, editable=False)
     
     class Meta:
         ordering = ['-index']
@@ -200,48 +300,88 @@ class Category(BaseModel):
     def __str__(self):
         return self.name
     
-    @cache_decorator(60 * 60 * 10)
+    def save(self, *args, **kwargs):
+        old_path = self.path
+        super().save(*args, **kwargs)
+        self.update_path(old_path)
+
+    def build_path(self):
+        if not self.parent_category_id:
+            return '/{id}/'.format(id=self.pk)
+        parent = self.parent_category
+        if not parent.path:
+            Category.rebuild_paths()
+            parent.refresh_from_db(fields=['path'])
+        return '{path}{id}/'.format(path=parent.path, id=self.pk)
+
+    def update_path(self, old_path):
+        """
+        保存后更新路径, 父级变化时同时更新所有子级的路径
+        """
+        path = self.build_path()
+        if path == old_path:
+            return
+        Category.objects.filter(pk=self.pk).update(path=path)
+        self.path = path
+        if old_path:
+            descendants = list(Category.objects.filter(
+                path__startswith=old_path).exclude(pk=self.pk))
+            for category in descendants:
+                category.path = path + category.path[len(old_path):]
+            Category.objects.bulk_update(descendants, ['path'])
+        # post_save已增加过版本号, 其间按旧路径缓存的子分类与父级在此之后失效
+        bump_namespace('category')
+
+    @classmethod
+    def rebuild_paths(cls):
+        """
+        按父级关系重新计算所有分类的路径
+        """
+        categories = {c.pk: c for c in cls.objects.all()}
+
+        def build(category, seen=()):
+            if category.parent_category_id is None or category.pk in seen:
+                return '/{id}/'.format(id=category.pk)
+            parent = categories[category.parent_category_id]
+            return build(parent, seen + (category.pk,)) + '{id}/'.format(id=category.pk)
+
+        for category in categories.values():
+            category.path = build(category)
+        cls.objects.bulk_update(categories.values(), ['path'])
+
+    def get_path(self):
+        if not self.path:
+            Category.rebuild_paths()
+            self.refresh_from_db(fields=['path'])
+        return self.path
+
+    @cache_decorator(60 * 60 * 10, namespaces=['category'])
     def get_category_tree(self):
         """
-        递归获得分类目录的父级
+        获得分类目录及其所有父级, 从当前分类到顶级分类
         :return:
         """
-        categorys = []
-        
-        def parse(category):
-            categorys.append(category)
-            if category.parent_category:
-                parse(category.parent_category)
-        
-        parse(self)
-        return categorys
-    
-    @cache_decorator(60 * 60 * 10)
+        ids = [int(i) for i in self.get_path().strip('/').split('/')]
+        categories = Category.objects.in_bulk(ids)
+        return [categories[i] for i in reversed(ids) if i in categories]
+
+    @cache_decorator(60 * 60 * 10, namespaces=['category'])
     def get_sub_categories(self):
         """
-        获得当前分类目录所有子集
+        获得当前分类目录及所有子集
         :return:
         """
-        categories = []
-        all_categories = Category.objects.all()
-        
-        def parse(category):
-            if category not in categories:
-                categories.append(category)
-            children = all_categories.filter(parent_category=category)
-            for child in children:
-                if category not in categories:
-                    categories.append(child)
-                parse(child)
-        
-        parse(self)
-        return categories
+        return list(Category.objects.filter(
+            path__startswith=self.get_path()).order_by('path'))
 
 
 class Tag(BaseModel):
     """文章标签"""
     name = models.CharField('Tag name', max_length=30, unique=True)
     slug = models.SlugField(default='no-slug', max_length=60, blank=True)
+    # 已发布文章数, 文章状态或标签变化时重新统计; 为空表示尚未统计, 读取时补全
+    article_count = models.PositiveIntegerField(
+            'Article count', null=True, default=None, editable=False)
     
     def __str__(self):
         return self.name
@@ -249,10 +389,44 @@ class Tag(BaseModel):
     def get_absolute_url(self):
         return reverse('blog:tag_detail', kwargs={'tag_name': self.slug})
     
-    @cache_decorator(60**2 * 10)
     def get_article_count(self):
-        return Article.objects.filter(tags__name=self.name).distinct().count()
-    
+        if self.article_count is None:
+            Tag.fill_article_counts([self])
+        return self.article_count
+
+    @classmethod
+    def fill_article_counts(cls, tags):
+        """
+        补全尚未统计文章数的标签, 如新增该字段前已有的标签
+        :return: tags
+        """
+        uncounted = {t.pk: t for t in tags if t.article_count is None}
+        if uncounted:
+            cls.update_article_counts(uncounted)
+            counts = cls.objects.filter(pk__in=uncounted).values_list('id', 'article_count')
+            for pk, count in counts:
+                uncounted[pk].article_count = count
+        return tags
+
+    @classmethod
+    def update_article_counts(cls, tag_ids=None):
+        """
+        重新统计标签的已发布文章数, 一条UPDATE完成, 只更新数量有变化的标签
+        :param tag_ids: 需要统计的标签, None表示全部
+        :return: 数量有变化的标签数
+        """
+        counts = Article.tags.through.objects.filter(
+            tag_id=OuterRef('pk'), article__status='p').order_by().values(
+            'tag_id').annotate(count=Count('article_id', distinct=True)).values('count')
+        tags = cls.objects.all()
+        if tag_ids is not None:
+            tag_ids = list(tag_ids)
+            if not tag_ids:
+                return 0
+            tags = tags.filter(pk__in=tag_ids)
+        count = Coalesce(Subquery(counts), 0)
+        return tags.exclude(article_count=count).update(article_count=count)
+
     class Meta:
         ordering = ['name']
         verbose_name = "Tag"
@@ -382,5 +556,5 @@ class BlogSettings(models.Model):
     
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
-        from djangoblog.utils import cache
-        cache.clear()
+        from djangoblog.utils import bump_model_namespaces
+        bump_model_namespaces(self)
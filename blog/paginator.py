@@ -0,0 +1,144 @@
+from django.core.paginator import EmptyPage, Page, PageNotAnInteger, Paginator
+from django.db import connections
+from django.db.models import BooleanField, Q
+from django.db.models.expressions import RawSQL
+from django.utils.translation import gettext_lazy as _
+
+from djangoblog.utils import cache, get_sha256, make_namespace_key
+
+
+class KeysetPage(Page):
+    """
+    是否有下一页由多取的一行判断, 不需要总数
+    """
+
+    def __init__(self, object_list, number, paginator, has_next):
+        super().__init__(object_list, number, paginator)
+        self._has_next = has_next
+
+    def has_next(self):
+        return self._has_next
+
+    def next_page_number(self):
+        if not self._has_next:
+            raise EmptyPage(_('That page contains no results'))
+        return self.number + 1
+
+    def previous_page_number(self):
+        if self.number <= 1:
+            raise EmptyPage(_('That page number is less than 1'))
+        return self.number - 1
+
+
+class KeysetPaginator(Paginator):
+    """
+    按排序字段的值定位分页, 代替COUNT(*)与OFFSET.
+    每ANCHOR_STEP页记录一次该页之前一行的排序字段值(锚点), 每个锚点单独缓存;
+    翻页时从最近的锚点开始查询, 只跳过不到ANCHOR_STEP页的行.
+    锚点在article_list命名空间下, 只有文章的增删或排序、筛选字段变化时失效
+    """
+    ordering = ('-article_order', '-pub_time', '-id')
+    anchors_timeout = 60 * 60 * 24
+    ANCHOR_STEP = 5
+    # 向前查找锚点的最大个数
+    ANCHOR_LOOKBACK = 20
+
+    def __init__(self, object_list, per_page, orphans=0,
+                 allow_empty_first_page=True, namespaces=('article_list',)):
+        super().__init__(object_list.order_by(*self.ordering), per_page,
+                         orphans, allow_empty_first_page)
+        self.fields = [f.lstrip('-') for f in self.ordering]
+        self.anchors_key = make_namespace_key(
+            list(namespaces),
+            'keyset_anchors_' + get_sha256(str(self.object_list.query)))
+
+    def validate_number(self, number):
+        try:
+            if isinstance(number, float) and not number.is_integer():
+                raise ValueError
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger(_('That page number is not an integer'))
+        if number < 1:
+            raise EmptyPage(_('That page number is less than 1'))
+        return number
+
+    def after(self, key):
+        """
+        排在锚点之后的行
+        """
+        descending = [f.startswith('-') for f in self.ordering]
+        if all(descending) or not any(descending):
+            # 行值比较可以直接按索引定位
+            model = self.object_list.model
+            connection = connections[self.object_list.db]
+            fields = [model._meta.get_field(f) for f in self.fields]
+            columns = ', '.join(
+                '{table}.{column}'.format(
+                    table=connection.ops.quote_name(model._meta.db_table),
+                    column=connection.ops.quote_name(f.column))
+                for f in fields)
+            params = [f.get_db_prep_value(v, connection) for f, v in zip(fields, key)]
+            condition = RawSQL('({columns}) {op} ({params})'.format(
+                columns=columns,
+                op='<' if descending[0] else '>',
+                params=', '.join(['%s'] * len(key))), params, output_field=BooleanField())
+            return self.object_list.filter(condition)
+        q = Q()
+        for i, desc in enumerate(descending):
+            condition = Q(**{self.fields[i] + ('__lt' if desc else '__gt'): key[i]})
+            for j in range(i):
+                condition &= Q(**{self.fields[j]: key[j]})
+            q |= condition
+        return self.object_list.filter(q)
+
+    def anchor_key(self, number):
+        return '{key}_{number}'.format(key=self.anchors_key, number=number)
+
+    def is_anchored(self, number):
+        return number > 1 and (number - 1) % self.ANCHOR_STEP == 0
+
+    def nearest_anchor(self, number):
+        """
+        :return: (页码, 锚点), 没有锚点时为(1, None)
+        """
+        start = number - (number - 1) % self.ANCHOR_STEP
+        numbers = list(range(start, 1, -self.ANCHOR_STEP))[:self.ANCHOR_LOOKBACK]
+        if not numbers:
+            return 1, None
+        found = cache.get_many([self.anchor_key(n) for n in numbers])
+        for n in numbers:
+            anchor = found.get(self.anchor_key(n))
+            if anchor is not None:
+                return n, anchor
+        return 1, None
+
+    def page(self, number):
+        number = self.validate_number(number)
+        start, anchor = self.nearest_anchor(number)
+        queryset = self.object_list if anchor is None else self.after(anchor)
+        # 本段没有锚点时从本段第一页读起, 以便记录本段的锚点
+        first = number - (number - 1) % self.ANCHOR_STEP
+        if first == start:
+            first = number
+        # 从锚点跳过之前的页, 多取前一行作为锚点, 多取后一行判断是否有下一页
+        skip = (first - start) * self.per_page
+        end = (number - start + 1) * self.per_page + 1
+        rows = list(queryset[max(skip - 1, 0):end])
+        if skip:
+            previous, rows = rows[:1], rows[1:]
+        rows = rows[(number - first) * self.per_page:]
+        has_next = len(rows) > self.per_page
+        object_list = rows[:self.per_page]
+        if not object_list and (number > 1 or not self.allow_empty_first_page):
+            raise EmptyPage(_('That page contains no results'))
+
+        anchors = {}
+        if skip and self.is_anchored(first):
+            anchors[self.anchor_key(first)] = tuple(getattr(previous[0], f) for f in self.fields)
+        if has_next and self.is_anchored(number + 1):
+            anchors[self.anchor_key(number + 1)] = tuple(
+                getattr(object_list[-1], f) for f in self.fields)
+        if anchors:
+            cache.set_many(anchors, self.anchors_timeout)
+        return KeysetPage(object_list, number, self, has_next)
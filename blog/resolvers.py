@@ -0,0 +1,54 @@
+import threading
+
+from django.http import Http404
+
+from blog.models import Category, Tag
+from djangoblog.utils import local_cache
+
+
+class SlugResolver:
+    """
+    slug到(id, name)的映射, 整张表一次读入进程内.
+    模型保存或删除后命名空间版本号变化, 下次解析时重新读取
+    """
+
+    def __init__(self, model, namespace):
+        self.model = model
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._version = None
+        self._by_slug = {}
+        self._by_name = {}
+
+    def _get_maps(self):
+        version = local_cache.namespace_versions([self.namespace])
+        if version != self._version:
+            with self._lock:
+                if version != self._version:
+                    by_slug = {}
+                    by_name = {}
+                    for pk, name, slug in self.model.objects.order_by('pk').values_list('pk', 'name', 'slug'):
+                        by_slug.setdefault(slug, (pk, name))
+                        by_name[name] = (pk, slug)
+                    self._by_slug, self._by_name = by_slug, by_name
+                    self._version = version
+        return self._by_slug, self._by_name
+
+    def resolve(self, slug):
+        """
+        :return: (id, name), 不存在时抛出Http404
+        """
+        value = self._get_maps()[0].get(slug)
+        if value is None:
+            raise Http404('No %s matches the given query.' % self.model._meta.object_name)
+        return value
+
+    def slug_for_name(self, name):
+        value = self._get_maps()[1].get(name)
+        if value is None:
+            raise Http404('No %s matches the given query.' % self.model._meta.object_name)
+        return value[1]
+
+
+category_resolver = SlugResolver(Category, 'category')
+tag_resolver = SlugResolver(Tag, 'tag')
@@ -18,6 +18,13 @@ function cancel_reply() {
     $("#commentform").appendTo($("#respond"));
 }
 
+function load_comments(link) {
+    $.get(link.href, function (html) {
+        $(link).closest('li').replaceWith(html);
+    });
+    return false;
+}
+
 NProgress.start();
 NProgress.set(0.4);
 //Increment
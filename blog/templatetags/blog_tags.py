@@ -1,3 +1,4 @@
+import datetime
 import hashlib
 import logging
 import random
@@ -7,15 +8,17 @@ import bleach
 from django import template
 from django.conf import settings
 from django.db.models import Q
-from django.shortcuts import get_object_or_404
 from django.template.defaultfilters import stringfilter
 from django.urls import reverse
 from django.utils.safestring import mark_safe
 
+from blog.indexes import get_archive_months
 from blog.models import Article, Category, Tag, Links, SideBar, LinkShowType
-from comments.models import Comment
+from blog.resolvers import category_resolver, tag_resolver
+from comments.utils import get_recent_comments
 from djangoblog.utils import CommonMarkdown
 from djangoblog.utils import cache
+from djangoblog.utils import local_cache, make_namespace_key
 from djangoblog.utils import get_current_site
 from oauth.models import OAuthUser
 
@@ -49,27 +52,6 @@ def custom_markdown(content):
     return mark_safe(CommonMarkdown.get_markdown(content))
 
 
-@register.simple_tag
-def get_markdown_toc(content):
-    from djangoblog.utils import CommonMarkdown
-    body, toc = CommonMarkdown.get_markdown_with_toc(content)
-    return mark_safe(toc), mark_safe(body)
-
-
-@register.filter(is_safe=True)
-@stringfilter
-def truncatechars_content(content):
-    """
-    Get a summary of the article
-    :param content:
-    :return:
-    """
-    from django.template.defaultfilters import truncatechars_html
-    from djangoblog.utils import get_blog_setting
-    blogsetting = get_blog_setting()
-    return truncatechars_html(content, blogsetting.article_sub_length)
-
-
 @register.filter(is_safe=True)
 @stringfilter
 def truncate(content):
@@ -106,7 +88,7 @@ def load_articletags(article):
     :param article:
     :return:
     """
-    tags = article.tags.all()
+    tags = Tag.fill_article_counts(list(article.tags.all()))
     tags_list = []
     for tag in tags:
         url = tag.get_absolute_url()
@@ -119,14 +101,25 @@ def load_articletags(article):
     }
 
 
+# 侧边栏由这些模型生成, 'sidebar'同时是SideBar模型与delete_sidebar_cache的命名空间
+SIDEBAR_NAMESPACES = ['sidebar', 'article', 'category', 'tag', 'links', 'blogsettings']
+
+
 @register.inclusion_tag('blog/tags/sidebar.html')
 def load_sidebar(user, linktype):
     """
     加载侧边栏
     :return:
     """
-    value = cache.get("sidebar" + linktype)
+    from blog.view_counter import get_most_read
+    key = make_namespace_key(SIDEBAR_NAMESPACES, "sidebar" + linktype)
+    value = cache.get(key)
     if value:
+        # 阅读排行写入阅读数时更新, 不随侧边栏缓存
+        value['most_read_articles'] = get_most_read(
+            value.get('sidebar_article_count'))
+        value['sidebar_comments'] = get_recent_comments(
+            value.get('sidebar_comment_count'))
         value['user'] = user
         return value
     else:
@@ -138,17 +131,15 @@ def load_sidebar(user, linktype):
         sidebar_categorys = Category.objects.all()
         extra_sidebars = SideBar.objects.filter(
             is_enable=True).order_by('sequence')
-        most_read_articles = Article.objects.filter(status='p').order_by(
-            '-views')[:blogsetting.sidebar_article_count]
-        dates = Article.objects.datetimes('created_time', 'month', order='DESC')
+        most_read_articles = get_most_read(blogsetting.sidebar_article_count)
+        dates = [datetime.date(year, month, 1)
+                 for year, months in get_archive_months() for month, _ in months]
         links = Links.objects.filter(is_enable=True).filter(
             Q(show_type=str(linktype)) | Q(show_type=LinkShowType.A))
-        commment_list = Comment.objects.filter(is_enable=True).order_by(
-            '-id')[:blogsetting.sidebar_comment_count]
         # 标签云 计算字体大小
         # 根据总数计算出平均值 大小为 (数目/平均值)*步长
         increment = 5
-        tags = Tag.objects.all()
+        tags = Tag.fill_article_counts(list(Tag.objects.all()))
         sidebar_tags = None
         if tags and len(tags) > 0:
             s = [t for t in [(t, t.get_article_count()) for t in tags] if t[1]]
@@ -163,8 +154,10 @@ def load_sidebar(user, linktype):
             'recent_articles': recent_articles,
             'sidebar_categorys': sidebar_categorys,
             'most_read_articles': most_read_articles,
+            'sidebar_article_count': blogsetting.sidebar_article_count,
             'article_dates': dates,
-            'sidebar_comments': commment_list,
+            'sidebar_comments': get_recent_comments(blogsetting.sidebar_comment_count),
+            'sidebar_comment_count': blogsetting.sidebar_comment_count,
             'sidabar_links': links,
             'show_google_adsense': blogsetting.show_google_adsense,
             'google_adsense_codes': blogsetting.google_adsense_codes,
@@ -173,7 +166,7 @@ def load_sidebar(user, linktype):
             'sidebar_tags': sidebar_tags,
             'extra_sidebars': extra_sidebars
         }
-        cache.set("sidebar" + linktype, value, 60 * 60 * 60 * 3)
+        cache.set(key, value, 60 * 60 * 60 * 3)
         value['user'] = user
         return value
 
@@ -205,21 +198,21 @@ def load_pagination_info(page_obj, page_type, tag_name):
                 'blog:index_page', kwargs={
                     'page': previous_number})
     if page_type == '分类标签归档':
-        tag = get_object_or_404(Tag, name=tag_name)
+        tag_slug = tag_resolver.slug_for_name(tag_name)
         if page_obj.has_next():
             next_number = page_obj.next_page_number()
             next_url = reverse(
                 'blog:tag_detail_page',
                 kwargs={
                     'page': next_number,
-                    'tag_name': tag.slug})
+                    'tag_name': tag_slug})
         if page_obj.has_previous():
             previous_number = page_obj.previous_page_number()
             previous_url = reverse(
                 'blog:tag_detail_page',
                 kwargs={
                     'page': previous_number,
-                    'tag_name': tag.slug})
+                    'tag_name': tag_slug})
     if page_type == '作者文章归档':
         if page_obj.has_next():
             next_number = page_obj.next_page_number()
@@ -237,21 +230,21 @@ def load_pagination_info(page_obj, page_type, tag_name):
                     'author_name': tag_name})
 
     if page_type == '分类目录归档':
-        category = get_object_or_404(Category, name=tag_name)
+        category_slug = category_resolver.slug_for_name(tag_name)
         if page_obj.has_next():
             next_number = page_obj.next_page_number()
             next_url = reverse(
                 'blog:category_detail_page',
                 kwargs={
                     'page': next_number,
-                    'category_name': category.slug})
+                    'category_name': category_slug})
         if page_obj.has_previous():
             previous_number = page_obj.previous_page_number()
             previous_url = reverse(
                 'blog:category_detail_page',
                 kwargs={
                     'page': previous_number,
-                    'category_name': category.slug})
+                    'category_name': category_slug})
 
     return {
         'previous_url': previous_url,
@@ -284,7 +277,7 @@ def load_article_detail(article, isindex, user):
 @register.filter
 def gravatar_url(email, size=40):
     """获得gravatar头像"""
-    cachekey = 'gravatat/' + email
+    cachekey = make_namespace_key(['oauthuser'], 'gravatat/' + email)
     if cache.get(cachekey):
         return cache.get(cachekey)
     else:
@@ -324,6 +317,17 @@ def query(qs, **kwargs):
     return qs.filter(**kwargs)
 
 
+@register.simple_tag
+def get_namespace_version(*namespaces):
+    """ 获得命名空间的版本号, 用作模板片段缓存的key, 命名空间版本增加后片段失效. Usage:
+          {% get_namespace_version 'category' 'article:'|addstr:article.pk as version %}
+          {% cache 36000 breadcrumb article.pk version %}
+            ...
+          {% endcache %}
+    """
+    return '.'.join(str(v) for v in local_cache.namespace_versions(namespaces))
+
+
 @register.filter
 def addstr(arg1, arg2):
     """concatenate arg1 & arg2"""
@@ -1,9 +1,10 @@
 import os
+from unittest import mock
 
 from django.conf import settings
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.core.management import call_command
-from django.core.paginator import Paginator
+from django.core.paginator import EmptyPage, Paginator
 from django.test import Client, RequestFactory, TestCase
 from django.urls import reverse
 from django.utils import timezone
@@ -11,8 +12,10 @@ from django.utils import timezone
 from accounts.models import BlogUser
 from blog.forms import BlogSearchForm
 from blog.models import Article, Category, Tag, SideBar, Links
+from blog.paginator import KeysetPaginator
 from blog.templatetags.blog_tags import load_pagination_info, load_articletags
-from djangoblog.utils import get_current_site, get_sha256
+from djangoblog.utils import get_current_site, get_sha256, get_blog_setting, cache, bump_namespace
+from djangoblog.utils import local_cache
 
 
 # Create your tests here.
@@ -21,6 +24,8 @@ class ArticleTest(TestCase):
     def setUp(self):
         self.client = Client()
         self.factory = RequestFactory()
+        cache.clear()
+        local_cache.clear()
 
     def test_validate_article(self):
         site = get_current_site().domain
@@ -83,8 +88,29 @@ class ArticleTest(TestCase):
             response = self.client.get('/search', {'q': 'nicetitle'})
             self.assertEqual(response.status_code, 200)
 
+        from blog.view_counter import flush_views, pending_views
+        flush_views()
+        views = Article.objects.get(pk=article.pk).views
         response = self.client.get(article.get_absolute_url())
         self.assertEqual(response.status_code, 200)
+        # 重复访问与爬虫不计数
+        self.client.get(article.get_absolute_url())
+        self.client.get(
+            article.get_absolute_url(),
+            HTTP_USER_AGENT='Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)')
+        response = self.client.get(article.get_absolute_url(), REMOTE_ADDR='10.0.0.2')
+        self.assertEqual(response.context['article'].views, views + 2)
+        self.assertEqual(Article.objects.get(pk=article.pk).views, views)
+        self.assertEqual(pending_views(article.pk), 2)
+        call_command("flush_views")
+        self.assertEqual(Article.objects.get(pk=article.pk).views, views + 2)
+        self.assertEqual(pending_views(article.pk), 0)
+        from blog.view_counter import get_most_read, get_trending
+        most_read = get_most_read(10)
+        self.assertEqual(most_read[0]['views'], max(a.views for a in Article.objects.filter(status='p')))
+        self.assertIn({'id': article.pk, 'title': article.title, 'url': article.get_absolute_url(),
+                       'views': views + 2}, most_read)
+        self.assertEqual(get_trending(1)[0]['id'], article.pk)
         from djangoblog.spider_notify import SpiderNotify
         SpiderNotify.notify(article.get_absolute_url())
         response = self.client.get(tag.get_absolute_url())
@@ -93,6 +119,23 @@ class ArticleTest(TestCase):
         response = self.client.get(category.get_absolute_url())
         self.assertEqual(response.status_code, 200)
 
+        # 缓存命中时不再按slug查询分类与标签
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        for url in [tag.get_absolute_url(), category.get_absolute_url()]:
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertFalse([q for q in context.captured_queries if '"slug" =' in q['sql']])
+        response = self.client.get(reverse('blog:tag_detail', kwargs={'tag_name': 'no-such-tag'}))
+        self.assertEqual(response.status_code, 404)
+        tag.name = 'renamedtag'
+        tag.save()
+        response = self.client.get(tag.get_absolute_url())
+        self.assertContains(response, 'renamedtag')
+        tag.name = 'nicetag'
+        tag.save()
+
         response = self.client.get('/search', {'q': 'django'})
         self.assertEqual(response.status_code, 200)
         s = load_articletags(article)
@@ -102,6 +145,13 @@ class ArticleTest(TestCase):
 
         response = self.client.get(reverse('blog:archives'))
         self.assertEqual(response.status_code, 200)
+        cache.set('seo_processor_unrelated', 1)
+        archive_title = 'archive new title'
+        article.title = archive_title
+        article.save()
+        response = self.client.get(reverse('blog:archives'))
+        self.assertContains(response, archive_title)
+        self.assertEqual(cache.get('seo_processor_unrelated'), 1)
 
         p = Paginator(Article.objects.all(), 2)
         self.__check_pagination__(p, '', '')
@@ -117,6 +167,60 @@ class ArticleTest(TestCase):
         p = Paginator(Article.objects.filter(category=category), 2)
         self.__check_pagination__(p, '分类目录归档', category.slug)
 
+        p = KeysetPaginator(Article.objects.all(), 2)
+        self.__check_pagination__(p, '', '')
+        # 发布时间相同时按id排序
+        Article.objects.filter(pk__in=[a.pk for a in Article.objects.all()[:6]]).update(
+            pub_time=timezone.now())
+        offset = Paginator(Article.objects.order_by(*KeysetPaginator.ordering), 3)
+        keyset = KeysetPaginator(Article.objects.all(), 3, namespaces=['keyset_test'])
+        # 先直接访问没有锚点的页, 再顺序翻页
+        for number in [5, 1, 2, 7, 6, offset.num_pages]:
+            self.assertEqual(list(keyset.page(number).object_list),
+                             list(offset.page(number).object_list))
+        self.assertFalse(keyset.page(offset.num_pages).has_next())
+        self.assertRaises(EmptyPage, keyset.page, offset.num_pages + 1)
+        # 每ANCHOR_STEP页记录一个锚点, 各自单独缓存
+        self.assertIsNotNone(cache.get(keyset.anchor_key(6)))
+        self.assertIsNone(cache.get(keyset.anchor_key(7)))
+        # 不影响列表的修改不使锚点失效, 排序字段变化时失效
+        KeysetPaginator(Article.objects.all(), 3).page(6)
+        article = Article.objects.order_by(*KeysetPaginator.ordering).first()
+        article.title = 'keyset title'
+        article.save()
+        self.assertIsNotNone(cache.get(KeysetPaginator(Article.objects.all(), 3).anchor_key(6)))
+        article.article_order = -1
+        article.save()
+        self.assertIsNone(cache.get(KeysetPaginator(Article.objects.all(), 3).anchor_key(6)))
+        # 缓存中只保存当前页文章的id, 命中时按id取出文章
+        from blog.views import IndexView
+        for paginator_class in [KeysetPaginator, Paginator]:
+            with mock.patch.object(IndexView, 'paginator_class', paginator_class):
+                bump_namespace('article')
+                url = reverse('blog:index_page', kwargs={'page': 2})
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                cached = self.client.get(url)
+            self.assertEqual(
+                [a.pk for a in response.context['article_list']],
+                [a.pk for a in cached.context['article_list']])
+            self.assertEqual(cached.context['page_obj'].number, 2)
+            self.assertTrue(cached.context['page_obj'].has_next())
+            self.assertTrue(cached.context['page_obj'].has_previous())
+
+        # 首页查询数与每页文章数无关
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        queries = []
+        for page_size in [2, 10]:
+            with mock.patch.object(IndexView, 'paginate_by', page_size):
+                bump_namespace('article')
+                with CaptureQueriesContext(connection) as context:
+                    response = self.client.get('/')
+            self.assertEqual(len(response.context['article_list']), page_size)
+            queries.append(len(context))
+        self.assertEqual(queries[0], queries[1])
+
         f = BlogSearchForm()
         f.search()
         # self.client.login(username='liangliangyy', password='liangliangyy')
@@ -187,6 +291,293 @@ class ArticleTest(TestCase):
         rsp = self.client.get('/eee')
         self.assertEqual(rsp.status_code, 404)
 
+    def test_rendered_content(self):
+        user = BlogUser.objects.get_or_create(
+            email="liangliangyy@gmail.com",
+            username="liangliangyy")[0]
+        category = Category()
+        category.name = "category"
+        category.save()
+
+        article = Article()
+        article.title = "rendertitle"
+        article.body = "# Title1\n\n```python\nimport os\n```\n\ncontent"
+        article.author = user
+        article.category = category
+        article.save()
+        self.assertIn('codehilite', article.body_html)
+        self.assertIn('Title1', article.toc_html)
+        self.assertEqual(article.body_hash, get_sha256(article.body))
+        self.assertNotIn('<', article.excerpt)
+
+        body_html = article.body_html
+        article.body_html = 'unchanged'
+        article.save()
+        self.assertEqual(article.body_html, 'unchanged')
+
+        article.body = 'new content'
+        article.save(update_fields=['body'])
+        article = Article.objects.get(pk=article.pk)
+        self.assertNotEqual(article.body_html, body_html)
+        self.assertIn('new content', article.body_html)
+
+        setting = get_blog_setting()
+        self.assertEqual(article.summary_length, setting.article_sub_length)
+        setting.article_sub_length = 5
+        setting.save()
+        response = self.client.get(reverse('blog:index'))
+        self.assertEqual(response.status_code, 200)
+        article = Article.objects.get(pk=article.pk)
+        self.assertEqual(article.summary_length, 5)
+        self.assertEqual(article.excerpt, 'new …')
+        article.set_summary('<p>Tom &amp; Jerry</p>', 300)
+        self.assertEqual(article.excerpt, 'Tom & Jerry')
+
+        Article.objects.filter(pk=article.pk).update(body_hash='', body_html='')
+        call_command("render_articles")
+        article = Article.objects.get(pk=article.pk)
+        self.assertIn('new content', article.body_html)
+
+    def test_category_path(self):
+        root = Category.objects.create(name='root')
+        child = Category.objects.create(name='child', parent_category=root)
+        grandchild = Category.objects.create(name='grandchild', parent_category=child)
+        other = Category.objects.create(name='other')
+        self.assertEqual(grandchild.path, '/{0}/{1}/{2}/'.format(root.pk, child.pk, grandchild.pk))
+        self.assertEqual(root.get_sub_categories(), [root, child, grandchild])
+        self.assertEqual(grandchild.get_category_tree(), [grandchild, child, root])
+
+        # 移动分类后子级路径随之更新, post_save与更新路径之间读取的结果不会被继续使用
+        from django.db.models.signals import post_save
+
+        def read_before_path_update(sender, instance, **kwargs):
+            other.get_sub_categories()
+
+        post_save.connect(read_before_path_update, sender=Category)
+        try:
+            child.parent_category = other
+            child.save()
+        finally:
+            post_save.disconnect(read_before_path_update, sender=Category)
+        grandchild.refresh_from_db()
+        self.assertEqual(grandchild.path, '/{0}/{1}/{2}/'.format(other.pk, child.pk, grandchild.pk))
+        self.assertEqual(root.get_sub_categories(), [root])
+        self.assertEqual(other.get_sub_categories(), [other, child, grandchild])
+        self.assertEqual(grandchild.get_category_tree(), [grandchild, child, other])
+
+        Category.objects.update(path='')
+        Category.rebuild_paths()
+        grandchild.refresh_from_db()
+        self.assertEqual(grandchild.path, '/{0}/{1}/{2}/'.format(other.pk, child.pk, grandchild.pk))
+
+    def test_tag_article_count(self):
+        user = BlogUser.objects.create(username='tagcount', email='tagcount@example.com')
+        category = Category.objects.create(name='tagcount')
+        tag1 = Tag.objects.create(name='tagcount1')
+        tag2 = Tag.objects.create(name='tagcount2')
+        article = Article.objects.create(
+            title='tagcount', body='tagcount', author=user, category=category)
+
+        def counts():
+            return list(Tag.objects.filter(pk__in=[tag1.pk, tag2.pk]).order_by(
+                'pk').values_list('article_count', flat=True))
+
+        article.tags.add(tag1, tag2)
+        self.assertEqual(counts(), [1, 1])
+        # 数量没有变化时不使标签与侧边栏缓存失效
+        from djangoblog.utils import get_namespace_versions
+        versions = get_namespace_versions(['tag', 'sidebar'])
+        article.save()
+        self.assertEqual(get_namespace_versions(['tag', 'sidebar']), versions)
+        # 新增字段前已有的标签在读取时补全
+        Tag.objects.update(article_count=None)
+        self.assertEqual(Tag.objects.get(pk=tag1.pk).get_article_count(), 1)
+        tags = Tag.fill_article_counts(list(Tag.objects.filter(pk=tag2.pk)))
+        self.assertEqual(tags[0].article_count, 1)
+        article.tags.remove(tag2)
+        self.assertEqual(counts(), [1, 0])
+        tag2.article_set.add(article)
+        self.assertEqual(counts(), [1, 1])
+        article.status = 'd'
+        article.save()
+        self.assertEqual(counts(), [0, 0])
+        article.status = 'p'
+        article.save()
+        article.tags.clear()
+        self.assertEqual(counts(), [0, 0])
+        article.tags.add(tag1)
+        article.delete()
+        self.assertEqual(counts(), [0, 0])
+
+        Tag.objects.filter(pk=tag1.pk).update(article_count=5)
+        call_command('reconcile_tag_counts')
+        self.assertEqual(counts(), [0, 0])
+
+    def test_flush_views_lost_pending(self):
+        import time
+        from django.core.cache import caches
+        from blog import view_counter
+        user = BlogUser.objects.create(username='viewholes', email='viewholes@example.com')
+        category = Category.objects.create(name='viewholes')
+        first, second = [Article.objects.create(
+            title='viewholes %d' % i, body='viewholes', author=user, category=category)
+            for i in range(2)]
+
+        view_counter.record_view(first.pk)
+        view_counter.record_view(second.pk)
+        seq = cache.get(view_counter.PENDING_SEQ_KEY)
+        # 第一篇的记录丢失, 之后的记录写入时间未超过等待时间时暂不跳过
+        cache.delete(view_counter.PENDING_KEY.format(seq=seq - 1))
+        self.assertEqual(view_counter.flush_views(), {})
+        cache.set(view_counter.PENDING_KEY.format(seq=seq),
+                  (second.pk, time.time() - view_counter.PENDING_GRACE - 1), None)
+        self.assertEqual(view_counter.flush_views(), {second.pk: 1})
+
+        # 标记过期后再次阅读时重新记录, 之前的计数一并写入
+        view_counter.record_view(first.pk)
+        self.assertEqual(view_counter.flush_views(), {})
+        cache.delete(view_counter.MARKED_KEY.format(id=first.pk))
+        view_counter.record_view(first.pk)
+        self.assertEqual(view_counter.flush_views(), {first.pk: 3})
+        self.assertEqual(Article.objects.get(pk=first.pk).views, 3)
+
+        # 计数在读取之后被淘汰, 已读取的部分仍然写入
+        view_counter.record_view(first.pk)
+        view_counter.record_view(second.pk)
+        with mock.patch.object(caches['default'], 'decr', side_effect=ValueError):
+            self.assertEqual(view_counter.flush_views(), {first.pk: 1, second.pk: 1})
+        self.assertEqual(Article.objects.get(pk=second.pk).views, 2)
+
+    def test_view_dedupe(self):
+        from django.test import override_settings
+        from blog.view_counter import is_new_view
+
+        def request(i):
+            return self.factory.get('/', REMOTE_ADDR='10.%d.%d.%d' % (i >> 16, (i >> 8) & 255, i & 255))
+
+        # 容量内的不同访客几乎全部计数, 重复访问不计数
+        counted = sum(is_new_view(1, request(i)) for i in range(4000))
+        self.assertGreaterEqual(counted, 3960)
+        self.assertFalse(is_new_view(1, request(0)))
+        # 访客数远超容量时换用新的过滤器, 新访客仍然计数
+        with override_settings(VIEW_DEDUPE_CAPACITY=500):
+            counted = sum(is_new_view(2, request(i)) for i in range(5000))
+        self.assertGreaterEqual(counted, 4950)
+
+    def test_fragment_versions(self):
+        user = BlogUser.objects.create(username='fragment', email='fragment@example.com')
+        category = Category.objects.create(name='fragmentcategory')
+        tag = Tag.objects.create(name='fragmenttag')
+        article = Article.objects.create(
+            title='fragment', body='fragment', author=user, category=category,
+            type='a', status='p')
+        article.tags.add(tag)
+        response = self.client.get(article.get_absolute_url())
+        self.assertContains(response, 'fragmentcategory')
+        self.assertContains(response, 'fragmenttag')
+
+        # 导航与文章底部信息的片段缓存随分类、标签更新
+        category.name = 'renamedcategory'
+        category.save()
+        tag.name = 'renamedtag'
+        tag.save()
+        response = self.client.get(article.get_absolute_url())
+        self.assertNotContains(response, 'fragmentcategory')
+        self.assertNotContains(response, 'fragmenttag')
+        self.assertContains(response, category.get_absolute_url())
+        self.assertContains(response, tag.get_absolute_url())
+
+    def test_archive_index(self):
+        from blog.indexes import INDEX_LOCK_KEY, get_archive_index
+        user = BlogUser.objects.create(username='archive', email='archive@example.com')
+        category = Category.objects.create(name='archive')
+        old = Article.objects.create(
+            title='archive old', body='old', author=user, category=category,
+            pub_time=timezone.now() - timezone.timedelta(days=400))
+        bump_namespace('archive')
+
+        def archived():
+            return [e[1] for _, entries in get_archive_index() for e in entries]
+
+        self.assertEqual(archived(), [old.pk])
+        with self.captureOnCommitCallbacks(execute=True):
+            new = Article.objects.create(
+                title='archive new', body='new', author=user, category=category, status='d')
+        self.assertEqual(archived(), [old.pk])
+        # 事务提交前索引不变
+        with self.captureOnCommitCallbacks(execute=True):
+            new.status = 'p'
+            new.save()
+            self.assertEqual(archived(), [old.pk])
+        self.assertEqual(archived(), [new.pk, old.pk])
+        self.assertEqual(len(get_archive_index()), 2)
+
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from blog.views import ArchivesView
+        response = self.client.get(reverse('blog:archives'))
+        self.assertContains(response, 'archive new')
+        self.assertContains(response, old.get_absolute_url())
+        # 侧边栏等已缓存, 绕过页面缓存直接渲染时不读取文章
+        request = self.factory.get(reverse('blog:archives'))
+        request.user = user
+        with CaptureQueriesContext(connection) as context:
+            ArchivesView.as_view()(request).render()
+        self.assertFalse([q for q in context.captured_queries if 'blog_article' in q['sql']])
+
+        # 移到其他月份时从原月份移除, 原月份为空时不再列出
+        with self.captureOnCommitCallbacks(execute=True):
+            old = Article.objects.get(pk=old.pk)
+            old.pub_time = new.pub_time - timezone.timedelta(minutes=1)
+            old.save()
+        self.assertEqual(get_archive_index(), [(
+            (new.pub_time.year, new.pub_time.month),
+            [(a.pub_time, a.pk, a.title, a.get_absolute_url()) for a in (new, old)])])
+
+        # 其他进程持有锁时, 更新使整个索引作废
+        cache.add(INDEX_LOCK_KEY, 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            old.status = 'd'
+            old.save()
+        self.assertEqual(archived(), [new.pk])
+        cache.delete(INDEX_LOCK_KEY)
+        with self.captureOnCommitCallbacks(execute=True):
+            new.delete()
+        self.assertEqual(get_archive_index(), [])
+
+    def test_neighbor_index(self):
+        from blog.indexes import get_neighbors, neighbor_index
+        user = BlogUser.objects.create(username='neighbor', email='neighbor@example.com')
+        category = Category.objects.create(name='neighbor')
+        base = timezone.now()
+        articles = [Article.objects.create(
+            title='neighbor%d' % i, body='neighbor', author=user, category=category,
+            pub_time=base + timezone.timedelta(minutes=i)) for i in range(4)]
+
+        def neighbors(article):
+            return tuple(n.id if n else None for n in get_neighbors(article))
+
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        # 索引读入进程后不再查询数据库, 也不读取整个索引
+        get_neighbors(articles[0])
+        with CaptureQueriesContext(connection) as context, \
+                mock.patch.object(cache, 'get', wraps=cache.get) as cache_get:
+            self.assertEqual(neighbors(articles[1]), (articles[0].pk, articles[2].pk))
+            self.assertEqual(articles[1].next_article().title, 'neighbor2')
+            self.assertEqual(articles[1].prev_article().url, articles[0].get_absolute_url())
+        self.assertEqual(len(context), 0)
+        self.assertEqual(cache_get.call_count, 0)
+        self.assertEqual(neighbors(articles[0]), (None, articles[1].pk))
+
+        articles[2].status = 'd'
+        articles[2].save()
+        self.assertEqual(neighbors(articles[1]), (articles[0].pk, articles[3].pk))
+        self.assertEqual(neighbors(articles[2]), (None, None))
+        articles[0].delete()
+        self.assertEqual(neighbors(articles[1]), (None, articles[3].pk))
+        self.assertEqual(len(neighbor_index._keys), 2)
+
     def test_commands(self):
         from blog.documents import ELASTICSEARCH_ENABLED
         if ELASTICSEARCH_ENABLED:
@@ -196,3 +587,12 @@ class ArticleTest(TestCase):
         call_command("clear_cache")
         call_command("sync_user_avatar")
         call_command("build_search_words")
+        call_command("render_articles", "--force")
+        from markdown.extensions import codehilite
+        from djangoblog.utils import highlight_cache
+        call_command("benchmark_markdown", "--number", "10", "--sections", "2")
+        # 基准结束后恢复带缓存的代码高亮
+        self.assertEqual(codehilite.highlight, highlight_cache.highlight)
+        call_command("benchmark_pagination", "--count", "50", "--page", "3")
+        call_command("reconcile_tag_counts")
+        call_command("reconcile_comment_counts")
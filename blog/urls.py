@@ -1,6 +1,6 @@
 from django.urls import path
-from django.views.decorators.cache import cache_page
 
+from djangoblog.utils import cache_page_with_namespaces
 from . import views
 
 app_name = "blog"
@@ -44,7 +44,7 @@ urlpatterns = [
     ),
     path(
         'archives.html',
-        cache_page(60 ** 2)(views.ArchivesView.as_view()),
+        cache_page_with_namespaces(60 ** 2, ['article'])(views.ArchivesView.as_view()),
         name='archives',
     ),
     path('links.html', views.LinkListView.as_view(), name='links'),
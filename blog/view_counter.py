@@ -0,0 +1,348 @@
+"""
+文章阅读数计数.
+爬虫的访问不计数, 同一访客在VIEW_DEDUPE_WINDOW秒内重复访问只计一次.
+阅读时只在缓存中原子递增, 由定时器或flush_views命令批量写入数据库,
+缓存丢失时最多损失VIEW_COUNT_FLUSH_INTERVAL秒内的计数
+"""
+import atexit
+import logging
+import math
+import threading
+import time
+from hashlib import sha256
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from ipware import get_client_ip
+from user_agents import parse
+
+from djangoblog.utils import cache, make_namespace_key
+
+logger = logging.getLogger(__name__)
+
+# 待写入数据库的阅读数
+COUNT_KEY = 'article_views_{id}'
+# 有待写入阅读数的文章按序号记录(文章id, 记录时间), 写入时只需读取上次写入之后的序号
+PENDING_SEQ_KEY = 'article_views_seq'
+PENDING_KEY = 'article_views_pending_{seq}'
+FLUSHED_SEQ_KEY = 'article_views_flushed_seq'
+# 序号之后的记录已写入超过该秒数而该序号仍缺失时, 视为记录已丢失(被淘汰或写入者异常退出)
+PENDING_GRACE = 10
+# 已写入的序号丢失时, 重新检查的最近记录数
+PENDING_RESCAN = 1000
+# 文章已有待写入记录的标记. 标记过期后再次阅读时重新记录, 记录丢失的计数最终仍会写入
+MARKED_KEY = 'article_views_marked_{id}'
+FLUSH_LOCK_KEY = 'article_views_flush_lock'
+FLUSH_LOCK_TIMEOUT = 60
+# 每篇文章每个时间窗口一个布隆过滤器, 访客在当前或上一个窗口中出现过则不计数
+SEEN_KEY = 'article_views_seen_{id}_{window}'
+# 阅读数排行, 写入阅读数时增量更新; 在article命名空间下, 文章保存后失效并重建
+MOST_READ_KEY = 'article_views_most_read'
+# 旧版本号下的排行不再被读取, 设置过期时间使其自然淘汰
+MOST_READ_TIMEOUT = 60 * 60 * 24
+# 按时间衰减的阅读数排行, score为对数形式, 避免随时间增大而溢出
+TRENDING_KEY = 'article_views_trending'
+# 衰减的计时起点
+TRENDING_EPOCH = 1577836800
+
+_timer_lock = threading.Lock()
+_timer_started = False
+
+
+def _incr(key, delta=1):
+    try:
+        return cache.incr(key, delta)
+    except ValueError:
+        cache.add(key, 0, None)
+        return cache.incr(key, delta)
+
+
+def _mark_pending(article_id):
+    """
+    文章没有待写入记录时记录一次
+    """
+    if cache.add(MARKED_KEY.format(id=article_id), 1, settings.VIEW_COUNT_FLUSH_INTERVAL * 10):
+        seq = _incr(PENDING_SEQ_KEY)
+        cache.set(PENDING_KEY.format(seq=seq), (article_id, time.time()), None)
+
+
+def pending_views(article_id):
+    """
+    :return: 尚未写入数据库的阅读数
+    """
+    return cache.get(COUNT_KEY.format(id=article_id)) or 0
+
+
+def record_view(article_id):
+    """
+    记录一次阅读
+    :return: 尚未写入数据库的阅读数, 包括本次
+    """
+    count = _incr(COUNT_KEY.format(id=article_id))
+    _mark_pending(article_id)
+    start_flush_timer()
+    return count
+
+
+class BloomFilter:
+    """
+    固定大小的布隆过滤器, 占用内存与访客数量无关, 可能误判为已访问但不会漏判.
+    记录数超过容量后误判率迅速上升, 由调用方换用新的过滤器
+    """
+
+    def __init__(self, size, hashes, data=None, count=0):
+        self.size = size
+        self.hashes = hashes
+        self.data = bytearray(data) if data else bytearray((size + 7) // 8)
+        self.count = count
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate, data=None, count=0):
+        """
+        按容量与误判率计算大小与哈希次数, 记录数不超过容量时误判率不超过error_rate
+        """
+        size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        hashes = max(1, int(round(size / capacity * math.log(2))))
+        return cls(size, hashes, data, count)
+
+    def _positions(self, item):
+        # 双重哈希, 哈希次数不受摘要长度限制
+        digest = sha256(item.encode('utf-8')).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:16], 'big') | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.data[pos // 8] |= 1 << (pos % 8)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.data[pos // 8] & (1 << (pos % 8))
+                   for pos in self._positions(item))
+
+
+def is_bot(request):
+    return parse(request.META.get('HTTP_USER_AGENT', '')).is_bot
+
+
+def client_id(request):
+    ip, _ = get_client_ip(request)
+    return '{ip}|{ua}'.format(ip=ip, ua=request.META.get('HTTP_USER_AGENT', ''))
+
+
+def _seen_filter(value=None):
+    data, count = value or (None, 0)
+    return BloomFilter.for_capacity(
+        settings.VIEW_DEDUPE_CAPACITY, settings.VIEW_DEDUPE_ERROR_RATE, data, count)
+
+
+def is_new_view(article_id, request):
+    """
+    检查并记录访客, 窗口内第一次访问时返回True
+    """
+    window = settings.VIEW_DEDUPE_WINDOW
+    current = int(time.time() // window)
+    keys = [SEEN_KEY.format(id=article_id, window=w) for w in (current, current - 1)]
+    found = cache.get_many(keys)
+    visitor = client_id(request)
+    for key in keys:
+        if key in found and visitor in _seen_filter(found[key]):
+            return False
+    seen = _seen_filter(found.get(keys[0]))
+    if seen.count >= settings.VIEW_DEDUPE_CAPACITY:
+        # 过滤器已满时换用新的过滤器, 之前的访客可能再计数一次, 但不会误判新访客
+        seen = _seen_filter()
+    # 并发写入同一过滤器时可能丢失记录, 只会导致少量重复计数
+    seen.add(visitor)
+    cache.set(keys[0], (bytes(seen.data), seen.count), window * 2)
+    return True
+
+
+def count_view(article_id, request):
+    """
+    处理一次文章访问, 爬虫与重复访问不计数
+    :return: 尚未写入数据库的阅读数
+    """
+    if is_bot(request) or not is_new_view(article_id, request):
+        return pending_views(article_id)
+    return record_view(article_id)
+
+
+def flush_views():
+    """
+    将缓存中的阅读数写入数据库
+    :return: {文章id: 增加的阅读数}
+    """
+    from blog.models import Article
+
+    if not cache.add(FLUSH_LOCK_KEY, 1, FLUSH_LOCK_TIMEOUT):
+        # 其他进程正在写入
+        return {}
+    try:
+        seq = cache.get(PENDING_SEQ_KEY, 0)
+        start = cache.get(FLUSHED_SEQ_KEY)
+        if start is None:
+            # 第一次写入或已写入的序号被淘汰, 已写入的记录已删除, 不会重复计数
+            start = max(0, seq - PENDING_RESCAN)
+        pending_keys = [PENDING_KEY.format(seq=i) for i in range(start + 1, seq + 1)]
+        pending = cache.get_many(pending_keys)
+        # 每个序号之后的记录中最早的记录时间
+        earliest_after = []
+        earliest = None
+        for key in reversed(pending_keys):
+            earliest_after.append(earliest)
+            if key in pending:
+                written = pending[key][1]
+                earliest = written if earliest is None else min(earliest, written)
+        earliest_after.reverse()
+
+        now = time.time()
+        ids = set()
+        flushed_keys = []
+        for key, earliest in zip(pending_keys, earliest_after):
+            if key in pending:
+                ids.add(pending[key][0])
+            elif earliest is None or now - earliest < PENDING_GRACE:
+                # 序号已分配但id还未写入, 下次再处理
+                break
+            else:
+                logger.warning('pending article views lost: %s' % key)
+            flushed_keys.append(key)
+
+        counts = cache.get_many([COUNT_KEY.format(id=i) for i in ids])
+        deltas = {}
+        for article_id in ids:
+            key = COUNT_KEY.format(id=article_id)
+            count = counts.get(key)
+            if not count:
+                continue
+            # 先删除标记, 之后的阅读会重新记录
+            cache.delete(MARKED_KEY.format(id=article_id))
+            try:
+                # 读取之后的阅读数保留在缓存中
+                left = cache.decr(key, count)
+            except ValueError:
+                # 计数在读取之后被淘汰, 已读取的部分仍然写入
+                left = 0
+            deltas[article_id] = count
+            if left > 0:
+                _mark_pending(article_id)
+
+        if deltas:
+            try:
+                with transaction.atomic():
+                    Article.objects.filter(pk__in=deltas).update(views=F('views') + Case(
+                        *[When(pk=pk, then=Value(count)) for pk, count in deltas.items()],
+                        default=Value(0),
+                        output_field=IntegerField()))
+            except Exception:
+                for article_id, count in deltas.items():
+                    _incr(COUNT_KEY.format(id=article_id), count)
+                    _mark_pending(article_id)
+                raise
+            update_rankings(deltas)
+        cache.delete_many(flushed_keys)
+        cache.set(FLUSHED_SEQ_KEY, start + len(flushed_keys), None)
+        logger.info('flush article views: %s', deltas)
+        return deltas
+    finally:
+        cache.delete(FLUSH_LOCK_KEY)
+
+
+def _ranking_entry(article):
+    return {
+        'id': article.id,
+        'title': article.title,
+        'url': article.get_absolute_url(),
+        'views': article.views}
+
+
+def get_most_read(count):
+    """
+    阅读数最多的文章
+    :return: [{'id', 'title', 'url', 'views'}]
+    """
+    key = make_namespace_key(['article'], MOST_READ_KEY)
+    entries = cache.get(key)
+    if entries is None:
+        from blog.models import Article
+        articles = Article.objects.filter(status='p').order_by(
+            '-views', '-id')[:settings.MOST_READ_SIZE]
+        entries = [_ranking_entry(a) for a in articles]
+        cache.set(key, entries, MOST_READ_TIMEOUT)
+    return entries[:count]
+
+
+def get_trending(count):
+    """
+    按时间衰减的阅读数排行, 近期的阅读权重更大
+    :return: [{'id', 'title', 'url', 'views', 'score'}]
+    """
+    return (cache.get(TRENDING_KEY) or [])[:count]
+
+
+def update_rankings(deltas):
+    """
+    阅读数写入数据库后更新排行, 只查询阅读数有变化的文章
+    :param deltas: {文章id: 增加的阅读数}
+    """
+    from blog.models import Article
+    articles = {a.id: a for a in Article.objects.filter(pk__in=deltas, status='p')}
+    size = settings.MOST_READ_SIZE
+
+    key = make_namespace_key(['article'], MOST_READ_KEY)
+    entries = cache.get(key)
+    if entries is not None:
+        # 阅读数只增不减, 不在排行中且没有变化的文章不会进入排行
+        ranking = {e['id']: e for e in entries}
+        for article in articles.values():
+            ranking[article.id] = _ranking_entry(article)
+        entries = sorted(ranking.values(), key=lambda e: (-e['views'], -e['id']))[:size]
+        cache.set(key, entries, MOST_READ_TIMEOUT)
+
+    # score = log(sum(delta * 2^((t - epoch) / half_life))), 已有的score无需随时间衰减.
+    # 排行不随文章保存失效, 每次更新时重新读取排行中文章的标题与状态
+    growth = (time.time() - TRENDING_EPOCH) / settings.TRENDING_HALF_LIFE * math.log(2)
+    scores = {e['id']: e['score'] for e in cache.get(TRENDING_KEY) or []}
+    for article_id, delta in deltas.items():
+        score = math.log(delta) + growth
+        old = scores.get(article_id)
+        if old is not None:
+            high, low = max(score, old), min(score, old)
+            score = high + math.log1p(math.exp(low - high))
+        scores[article_id] = score
+    top = sorted(scores, key=lambda i: -scores[i])
+    articles.update({
+        a.id: a for a in Article.objects.filter(
+            pk__in=set(top) - set(articles), status='p')})
+    entries = [dict(_ranking_entry(articles[i]), score=scores[i])
+               for i in top if i in articles][:size]
+    cache.set(TRENDING_KEY, entries, None)
+
+
+def _flush_loop():
+    while True:
+        time.sleep(settings.VIEW_COUNT_FLUSH_INTERVAL)
+        try:
+            flush_views()
+        except Exception as e:
+            logger.error('flush article views failed: %s' % e)
+
+
+def start_flush_timer():
+    """
+    每个进程第一次记录阅读时启动定时写入, 进程退出时写入剩余的计数
+    """
+    global _timer_started
+    if _timer_started or settings.TESTING:
+        return
+    with _timer_lock:
+        if _timer_started:
+            return
+        _timer_started = True
+    t = threading.Thread(target=_flush_loop, name='flush_views', daemon=True)
+    t.start()
+    atexit.register(flush_views)
@@ -6,16 +6,22 @@ import uuid
 
 from django import forms
 from django.conf import settings
+from django.core.paginator import Page, Paginator
 from django.http import HttpResponse, HttpResponseForbidden
-from django.shortcuts import get_object_or_404
 from django.shortcuts import render
+from django.utils.functional import SimpleLazyObject
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic.detail import DetailView
 from django.views.generic.list import ListView
 
-from blog.models import Article, Category, Tag, Links, LinkShowType
+from blog.indexes import get_archive_months
+from blog.models import Article, Category, Links, LinkShowType
+from blog.paginator import KeysetPage, KeysetPaginator
+from blog.resolvers import category_resolver, tag_resolver
 from comments.forms import CommentForm
-from djangoblog.utils import cache, get_sha256, get_blog_setting
+from comments.utils import get_comment_page
+from djangoblog.utils import cache, get_sha256, get_blog_setting, CommonMarkdown
+from djangoblog.utils import make_namespace_key
 
 logger = logging.getLogger(__name__)
 
@@ -32,6 +38,12 @@ class ArticleListView(ListView):
     paginate_by = settings.PAGINATE_BY
     page_kwarg = 'page'
     link_type = LinkShowType.L
+    # 列表页是否显示文章摘要
+    show_article_summary = True
+    # 列表缓存所属的命名空间, 命名空间对应的模型保存时缓存失效
+    cache_namespaces = ['article']
+    if settings.KEYSET_PAGINATION:
+        paginator_class = KeysetPaginator
 
     def get_view_cache_key(self):
         return self.request.get['pages']
@@ -54,33 +66,90 @@ class ArticleListView(ListView):
         """
         raise NotImplementedError()
 
+    @staticmethod
+    def with_card_data(queryset):
+        """
+        列表卡片用到的作者、分类及标签一并查询, 查询数与每页数量无关
+        """
+        return queryset.select_related('author', 'category').prefetch_related('tags')
+
+    def get_articles(self, ids):
+        """
+        按id一次取出文章, 保持id的顺序
+        """
+        articles = self.with_card_data(Article.objects.all()).in_bulk(ids)
+        return [articles[pk] for pk in ids if pk in articles]
+
     def get_queryset_from_cache(self, cache_key):
         """
-        缓存页面数据
+        缓存页面数据, 只缓存当前页文章的id
         :param cache_key: 缓存key
         :return:
         """
+        self.queryset_cache_key = cache_key
         value = cache.get(cache_key)
         if value:
             logger.info('get view cache.key:{key}'.format(key=cache_key))
-            return value
-        else:
-            article_list = self.get_queryset_data()
-            cache.set(cache_key, article_list)
-            logger.info('set view cache.key:{key}'.format(key=cache_key))
-            return article_list
+            self.cached_page = value
+            return self.get_articles(value['ids'])
+        # 当前页的id在paginate_queryset中缓存
+        return self.get_queryset_data()
 
     def get_queryset(self):
         """
         重写默认，从缓存获取数据
         :return:
         """
-        key = self.get_queryset_cache_key()
+        self.cached_page = None
+        key = make_namespace_key(
+            self.cache_namespaces, self.get_queryset_cache_key())
         return self.get_queryset_from_cache(key)
 
+    def paginate_queryset(self, queryset, page_size):
+        value = self.cached_page
+        if value is None:
+            paginator, page, object_list, is_paginated = super().paginate_queryset(
+                self.with_card_data(queryset), page_size)
+            value = {
+                'ids': [a.pk for a in object_list],
+                'number': page.number,
+                'has_next': page.has_next()}
+            if not isinstance(paginator, KeysetPaginator):
+                value['count'] = paginator.count
+            cache.set(self.queryset_cache_key, value)
+            logger.info('set view cache.key:{key}'.format(key=self.queryset_cache_key))
+            return paginator, page, object_list, is_paginated
+
+        # queryset只包含当前页的文章
+        paginator = Paginator(queryset, page_size)
+        if 'count' in value:
+            paginator.count = value['count']
+            page = Page(queryset, value['number'], paginator)
+        else:
+            page = KeysetPage(queryset, value['number'], paginator, value['has_next'])
+        return paginator, page, page.object_list, page.has_other_pages()
+
+    def render_article_summaries(self, article_list):
+        """
+        批量渲染当前页中摘要缺失或摘要长度设置已变化的文章
+        """
+        length = get_blog_setting().article_sub_length
+        articles = [a for a in article_list if a.summary_length != length]
+        if not articles:
+            return
+        summaries = CommonMarkdown.get_markdown_summary_batch(
+            [a.body for a in articles], length)
+        for article, summary in zip(articles, summaries):
+            article.set_summary(summary, length)
+            Article.objects.filter(pk=article.pk).update(
+                **{f: getattr(article, f) for f in Article.SUMMARY_FIELDS})
+
     def get_context_data(self, **kwargs):
         kwargs['linktype'] = self.link_type
-        return super(ArticleListView, self).get_context_data(**kwargs)
+        context = super(ArticleListView, self).get_context_data(**kwargs)
+        if self.show_article_summary:
+            self.render_article_summaries(context['object_list'])
+        return context
 
 
 class IndexView(ArticleListView):
@@ -108,7 +177,11 @@ class ArticleDetailView(DetailView):
 
     def get_object(self, queryset=None):
         obj = super(ArticleDetailView, self).get_object()
-        obj.viewed()
+        if not obj.body_hash and obj.render_body():
+            # 兼容未保存渲染结果的旧文章
+            Article.objects.filter(pk=obj.pk).update(
+                **{f: getattr(obj, f) for f in Article.RENDERED_FIELDS})
+        obj.viewed(self.request)
         self.object = obj
         return obj
 
@@ -125,12 +198,11 @@ class ArticleDetailView(DetailView):
             comment_form.fields["email"].initial = user.email
             comment_form.fields["name"].initial = user.username
 
-        article_comments = self.object.comment_list()
-
         kwargs['form'] = comment_form
-        kwargs['article_comments'] = article_comments
-        kwargs['comment_count'] = len(
-            article_comments) if article_comments else 0
+        # 评论片段缓存命中时不读取评论列表
+        kwargs['comment_page'] = SimpleLazyObject(
+            lambda: get_comment_page(self.object.comment_list()))
+        kwargs['comment_count'] = self.object.comment_count
 
         kwargs['next_article'] = self.object.next_article
         kwargs['prev_article'] = self.object.prev_article
@@ -143,22 +215,17 @@ class CategoryDetailView(ArticleListView):
     分类目录列表
     """
     page_type = "Category Archives"
+    cache_namespaces = ['article', 'category']
 
     def get_queryset_data(self):
-        slug = self.kwargs['category_name']
-        category = get_object_or_404(Category, slug=slug)
-
-        categoryname = category.name
-        self.categoryname = categoryname
-        categorynames = list(
-            map(lambda c: c.name, category.get_sub_categories()))
+        category = Category.objects.get(pk=self.category_id)
+        category_ids = [c.id for c in category.get_sub_categories()]
         return Article.objects.filter(
-            category__name__in=categorynames, status='p')
+            category_id__in=category_ids, status='p')
 
     def get_queryset_cache_key(self):
         slug = self.kwargs['category_name']
-        category = get_object_or_404(Category, slug=slug)
-        categoryname = category.name
+        self.category_id, categoryname = category_resolver.resolve(slug)
         self.categoryname = categoryname
         return 'category_list_{categoryname}_{page}'.format(
             categoryname=categoryname, page=self.page_number)
@@ -180,6 +247,7 @@ class AuthorDetailView(ArticleListView):
     作者详情页
     """
     page_type = 'Author Archive'
+    cache_namespaces = ['article', 'bloguser']
 
     def get_queryset_cache_key(self):
         from uuslug import slugify
@@ -202,18 +270,14 @@ class TagDetailView(ArticleListView):
     标签列表页面
     """
     page_type = 'Tag Archive'
+    cache_namespaces = ['article', 'tag']
 
     def get_queryset_data(self):
-        slug = self.kwargs['tag_name']
-        tag = get_object_or_404(Tag, slug=slug)
-        tag_name = tag.name
-        self.name = tag_name
-        return Article.objects.filter(tags__name=tag_name, type='a', status='p')
+        return Article.objects.filter(tags__id=self.tag_id, type='a', status='p')
 
     def get_queryset_cache_key(self):
         slug = self.kwargs['tag_name']
-        tag = get_object_or_404(Tag, slug=slug)
-        tag_name = tag.name
+        self.tag_id, tag_name = tag_resolver.resolve(slug)
         self.name = tag_name
         return 'tag_{tag_name}_{page}'.format(tag_name=tag_name, page=self.page_number)
 
@@ -232,13 +296,16 @@ class ArchivesView(ArticleListView):
     page_type = 'Article Archive'
     paginate_by = None
     page_kwarg = None
+    show_article_summary = False
     template_name = 'blog/article_archives.html'
 
-    def get_queryset_data(self):
-        return Article.objects.filter(status='p').all()
+    def get_queryset(self):
+        # 归档页面只使用归档索引, 不读取文章
+        return Article.objects.none()
 
-    def get_queryset_cache_key(self):
-        return 'archives'
+    def get_context_data(self, **kwargs):
+        kwargs['archive_years'] = get_archive_months()
+        return super(ArchivesView, self).get_context_data(**kwargs)
 
 
 class LinkListView(ListView):
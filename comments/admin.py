@@ -3,13 +3,22 @@ from django.contrib import admin
 from django.urls import reverse
 from django.utils.html import format_html
 
+from .utils import invalidate_comment_caches
+
+
+def update_comment_status(queryset, is_enable):
+    article_ids = set(queryset.values_list('article_id', flat=True))
+    queryset.update(is_enable=is_enable)
+    # update()不触发信号
+    invalidate_comment_caches(article_ids)
+
 
 def disable_commentstatus(modeladmin, request, queryset):
-    queryset.update(is_enable=False)
+    update_comment_status(queryset, False)
 
 
 def enable_commentstatus(modeladmin, request, queryset):
-    queryset.update(is_enable=True)
+    update_comment_status(queryset, True)
 
 
 disable_commentstatus.short_description = 'Disable comments'
@@ -1,4 +1,9 @@
+import bleach
 from django import template
+from django.utils.safestring import mark_safe
+
+from comments.utils import build_comment_tree
+from djangoblog.utils import CommonMarkdown
 
 register = template.Library()
 
@@ -8,11 +13,11 @@ def parse_commenttree(commentlist, comment):
     """获得当前评论子评论的列表
         用法: {% parse_commenttree article_comments comment as childcomments %}
     """
+    tree = build_comment_tree(commentlist)
     datas = []
 
     def parse(c):
-        childs = commentlist.filter(parent_comment=c, is_enable=True)
-        for child in childs:
+        for child in tree.get(c.pk, []):
             datas.append(child)
             parse(child)
 
@@ -20,6 +25,27 @@ def parse_commenttree(commentlist, comment):
     return datas
 
 
+@register.simple_tag
+def get_comment_bodies(commentlist):
+    """批量渲染评论内容
+        用法: {% get_comment_bodies article_comments as comment_bodies %}
+    """
+    comments = list(commentlist)
+    bodies = CommonMarkdown.get_markdown_batch(
+        [bleach.clean(c.body) for c in comments])
+    return {c.pk: mark_safe(body) for c, body in zip(comments, bodies)}
+
+
+@register.filter
+def comment_body(comment_bodies, comment):
+    """获得评论渲染后的内容, 未批量渲染时单独渲染
+        用法: {{ comment_bodies|comment_body:comment_item }}
+    """
+    if comment_bodies and comment.pk in comment_bodies:
+        return comment_bodies[comment.pk]
+    return mark_safe(CommonMarkdown.get_markdown(bleach.clean(comment.body)))
+
+
 @register.inclusion_tag('comments/tags/comment_item.html')
 def show_comment_item(comment, ischild):
     """评论"""
@@ -6,7 +6,7 @@ from accounts.models import BlogUser
 from blog.models import Category, Article
 from comments.models import Comment
 from comments.templatetags.comments_tags import *
-from djangoblog.utils import get_current_site
+from djangoblog.utils import cache, get_current_site
 from djangoblog.utils import get_max_articleid_commentid
 
 
@@ -16,6 +16,7 @@ class CommentsTest(TestCase):
     def setUp(self):
         self.client = Client()
         self.factory = RequestFactory()
+        cache.clear()
 
     def test_validate_comment(self):
         site = get_current_site().domain
@@ -97,8 +98,194 @@ class CommentsTest(TestCase):
         self.assertEqual(len(tree), 1)
         data = show_comment_item(comment, True)
         self.assertIsNotNone(data)
+        bodies = get_comment_bodies(article.comment_list())
+        self.assertEqual(len(bodies), 2)
+        self.assertEqual(comment_body(bodies, comment), bodies[comment.pk])
+        self.assertEqual(comment_body('', comment), bodies[comment.pk])
+        response = self.client.get(article.get_absolute_url())
+        self.assertContains(response, 'codehilite')
         s = get_max_articleid_commentid()
         self.assertIsNotNone(s)
 
         from comments.utils import send_comment_email
         send_comment_email(comment)
+
+    def test_comment_tree(self):
+        user = BlogUser.objects.create_user(
+            email="commenttree@gmail.com",
+            username="commenttree",
+            password="commenttree")
+        category = Category.objects.create(name="commenttree")
+        article = Article.objects.create(
+            title="commenttree", body="commenttree", author=user,
+            category=category, type='a', status='p')
+        # 每10条评论一个回复链, 最后一条未启用
+        Comment.objects.bulk_create([Comment(
+            id=i + 1, body='comment %d' % i, author=user, article=article,
+            parent_comment_id=i if i % 10 else None,
+            is_enable=i != 499) for i in range(500)])
+        from blog.templatetags.blog_tags import gravatar_url
+        from django.template.loader import render_to_string
+        from comments.utils import build_comment_tree, get_comment_page
+        gravatar_url(user.email, 150)
+
+        with self.assertNumQueries(1):
+            comments = article.comment_list()
+            page = get_comment_page(comments)
+            html = render_to_string('comments/tags/comment_list.html', {
+                'article': article,
+                'comment_page': page,
+                'comment_count': len(comments)})
+        self.assertEqual(len(comments), 499)
+        tree = build_comment_tree(comments)
+        self.assertEqual(len(tree[None]), 50)
+        # 第一页只包括20个根评论及其回复
+        self.assertEqual(html.count('class="comment-body"'), 200)
+        self.assertEqual(page.next_after, tree[None][19].pk)
+        self.assertEqual([depth for _, depth in page.entries[:3]], [0, 1, 1])
+        root = tree[None][0]
+        self.assertEqual(len(parse_commenttree(comments, root)), 9)
+        self.assertEqual(tree[root.pk][0].parent_comment, root)
+
+        url = reverse('comments:comment_page', kwargs={'article_id': article.id})
+        response = self.client.get(url, {'after': page.next_after})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'class="comment-body"', count=200)
+        self.assertContains(response, 'Load more comments')
+        response = self.client.get(url, {'after': tree[None][39].pk, 'format': 'json'})
+        data = response.json()
+        self.assertEqual(len(data['comments']), 99)
+        self.assertIsNone(data['next'])
+        self.assertEqual(data['comments'][1]['parent_id'], data['comments'][0]['id'])
+        response = self.client.get(url, {'after': 'x'})
+        self.assertEqual(response.status_code, 400)
+
+        # 回复较多的根评论只带COMMENT_REPLY_PAGE_SIZE条回复, 其余回复分页读取
+        thread = Article.objects.create(
+            title="commentthread", body="commentthread", author=user,
+            category=category, type='a', status='p')
+        root = Comment.objects.bulk_create([Comment(
+            id=1000, body='root', author=user, article=thread)])[0]
+        Comment.objects.bulk_create([Comment(
+            id=1001 + i, body='reply %d' % i, author=user, article=thread,
+            parent_comment=root) for i in range(25)])
+        page = get_comment_page(thread.comment_list())
+        self.assertEqual(len(page.entries), 11)
+        self.assertEqual(page.threads[0].more_start, 10)
+        url = reverse('comments:comment_page', kwargs={'article_id': thread.id})
+        response = self.client.get(url, {'root': root.pk, 'start': 10})
+        self.assertContains(response, 'class="comment-body"', count=10)
+        self.assertContains(response, 'start=20')
+        response = self.client.get(url, {'root': root.pk, 'start': 20})
+        self.assertContains(response, 'class="comment-body"', count=5)
+        self.assertNotContains(response, 'Load more replies')
+        data = self.client.get(url, {'format': 'json'}).json()
+        self.assertEqual(len(data['comments']), 11)
+        data = self.client.get(data['comments'][0]['more_replies']).json()
+        self.assertEqual(data['comments'][0]['id'], 1011)
+        self.assertEqual(len(self.client.get(data['next']).json()['comments']), 5)
+
+        # 片段与评论页缓存命中时不读取评论列表
+        from unittest import mock
+        Comment(body='new reply', author=user, article=thread, parent_comment=root).save()
+        for page_url in [thread.get_absolute_url(), url]:
+            response = self.client.get(page_url)
+            self.assertContains(response, 'Load more replies')
+            with mock.patch.object(Article, 'comment_list') as comment_list:
+                self.client.get(page_url)
+            self.assertFalse(comment_list.called)
+
+    def test_comment_count(self):
+        from django.core.management import call_command
+        from comments.admin import disable_commentstatus, enable_commentstatus
+        user = BlogUser.objects.create_user(
+            email="commentcount@gmail.com",
+            username="commentcount",
+            password="commentcount")
+        category = Category.objects.create(name="commentcount")
+        article = Article.objects.create(
+            title="commentcount", body="commentcount", author=user,
+            category=category, type='a', status='p')
+
+        def count():
+            return Article.objects.get(pk=article.pk).get_comment_count()
+
+        first = Comment.objects.create(body='first', author=user, article=article)
+        second = Comment.objects.create(
+            body='second', author=user, article=article, parent_comment=first)
+        self.assertEqual(count(), 2)
+        second.is_enable = False
+        second.save()
+        self.assertEqual(count(), 1)
+        enable_commentstatus(None, None, Comment.objects.filter(pk=second.pk))
+        self.assertEqual(count(), 2)
+        self.assertEqual(len(article.comment_list()), 2)
+        disable_commentstatus(None, None, Comment.objects.filter(article=article))
+        self.assertEqual(count(), 0)
+        self.assertEqual(len(article.comment_list()), 0)
+        enable_commentstatus(None, None, Comment.objects.filter(article=article))
+        second.delete()
+        self.assertEqual(count(), 1)
+
+        Article.objects.filter(pk=article.pk).update(comment_count=5)
+        call_command('reconcile_comment_counts')
+        self.assertEqual(count(), 1)
+        article.delete()
+        self.assertFalse(Comment.objects.filter(pk=first.pk).exists())
+
+    def test_comment_cache_invalidation(self):
+        from contextlib import ExitStack
+        from unittest import mock
+        from django.core.cache import caches
+        from blog.context_processors import seo_processor
+        from blog.models import LinkShowType
+        from blog.templatetags.blog_tags import SIDEBAR_NAMESPACES, load_sidebar
+        from djangoblog.utils import local_cache, make_namespace_key
+        user = BlogUser.objects.create_user(
+            email="commentcache@gmail.com",
+            username="commentcache",
+            password="commentcache")
+        category = Category.objects.create(name="commentcache")
+        article = Article.objects.create(
+            title="commentcache", body="commentcache", author=user,
+            category=category, type='a', status='p')
+        seo_processor(self.factory.get('/'))
+        for linktype in (LinkShowType.I, LinkShowType.L):
+            self.assertEqual(load_sidebar(user, linktype)['sidebar_comments'], [])
+        comments_key = make_namespace_key([article.comments_namespace()], 'comments')
+
+        backend = caches['default']
+        ops = []
+        depth = [0]
+
+        def counting(name, method):
+            # 只记录最外层的调用, 如get_many内部的get不计
+            def wrapper(*args, **kwargs):
+                if not depth[0]:
+                    ops.append(name)
+                depth[0] += 1
+                try:
+                    return method(*args, **kwargs)
+                finally:
+                    depth[0] -= 1
+            return wrapper
+
+        with ExitStack() as stack:
+            for name in ('get', 'set', 'add', 'delete', 'incr', 'decr',
+                         'get_many', 'set_many', 'delete_many'):
+                stack.enter_context(mock.patch.object(
+                    backend, name, counting(name, getattr(backend, name))))
+            comment = Comment.objects.create(body='cache', author=user, article=article)
+        # 文章评论与最新评论的命名空间版本号加一
+        self.assertEqual(ops, ['incr', 'incr'])
+
+        self.assertIsNotNone(local_cache.get(
+            'seo_processor', ['blogsettings', 'category', 'article']))
+        for linktype in (LinkShowType.I, LinkShowType.L):
+            self.assertIsNotNone(cache.get(
+                make_namespace_key(SIDEBAR_NAMESPACES, 'sidebar' + linktype)))
+            self.assertEqual(load_sidebar(user, linktype)['sidebar_comments'], [comment])
+        self.assertNotEqual(
+            make_namespace_key([article.comments_namespace()], 'comments'), comments_key)
+        self.assertEqual(Article.objects.get(pk=article.pk).comment_count, 1)
+
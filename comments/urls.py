@@ -9,4 +9,8 @@ urlpatterns = [
         'article/<int:article_id>/postcomment',
         views.CommentPostView.as_view(),
         name='postcomment'),
+    path(
+        'article/<int:article_id>/comments',
+        views.CommentPageView.as_view(),
+        name='comment_page'),
 ]
@@ -1,10 +1,126 @@
+import bisect
 import logging
+from collections import namedtuple
 
+from django.conf import settings
+
+from blog.models import Article
+from djangoblog.utils import cache, bump_namespace, make_namespace_key
 from djangoblog.utils import get_current_site
 from djangoblog.utils import send_email
 
 logger = logging.getLogger(__name__)
 
+# 侧边栏最新评论: (条数, [评论]), 与侧边栏分开缓存, 评论变化时不影响侧边栏其他部分.
+# 显示了评论者与文章标题, 同时随文章与用户失效
+RECENT_COMMENTS_KEY = 'sidebar_recent_comments'
+RECENT_COMMENTS_NAMESPACES = ['recent_comments', 'article', 'bloguser']
+
+
+def get_recent_comments(count):
+    key = make_namespace_key(RECENT_COMMENTS_NAMESPACES, RECENT_COMMENTS_KEY)
+    value = cache.get(key)
+    if value is None or value[0] < count:
+        from comments.models import Comment
+        comments = list(Comment.objects.filter(is_enable=True).select_related(
+            'author', 'article').order_by('-id')[:count])
+        value = (count, comments)
+        cache.set(key, value, 60 * 60 * 60 * 3)
+    return value[1][:count]
+
+
+def invalidate_comment_caches(article_ids):
+    """
+    评论新增、修改、删除或启用状态变化后, 只重新统计文章评论数,
+    使文章评论列表与评论片段以及侧边栏最新评论失效
+    """
+    article_ids = set(article_ids)
+    Article.update_comment_counts(article_ids)
+    for article_id in article_ids:
+        bump_namespace(Article(id=article_id).comments_namespace())
+    bump_namespace('recent_comments')
+
+
+def build_comment_tree(comments):
+    """
+    一次遍历将评论按父评论id分组
+    :return: {父评论id或None: [子评论]}
+    """
+    tree = {}
+    for comment in comments:
+        tree.setdefault(comment.parent_comment_id, []).append(comment)
+    return tree
+
+
+# 一个根评论及其回复. entries: [(评论, 缩进层级)], 按显示顺序;
+# more_start: 其余回复在该根评论全部回复中的起始位置, 没有更多回复时为None
+CommentThread = namedtuple('CommentThread', ['root', 'entries', 'more_start'])
+
+
+class CommentPage(namedtuple('CommentPage', ['threads', 'next_after'])):
+    """
+    一页评论. next_after: 下一页的after参数, 没有下一页时为None
+    """
+
+    @property
+    def entries(self):
+        return [entry for thread in self.threads for entry in thread.entries]
+
+    @property
+    def comments(self):
+        return [comment for comment, _ in self.entries]
+
+
+def _thread_replies(tree, root):
+    """
+    根评论的全部回复, 按显示顺序, 超过COMMENT_MAX_DEPTH的回复按最大层级缩进
+    """
+    replies = []
+    stack = [(child, 1) for child in reversed(tree.get(root.pk, []))]
+    while stack:
+        comment, depth = stack.pop()
+        replies.append((comment, min(depth, settings.COMMENT_MAX_DEPTH)))
+        stack.extend((child, depth + 1) for child in reversed(tree.get(comment.pk, [])))
+    return replies
+
+
+def _thread(root, replies, start, size):
+    end = start + size
+    return CommentThread(root, replies[start:end], end if end < len(replies) else None)
+
+
+def get_comment_page(comments, after=None, size=None, reply_size=None):
+    """
+    按根评论id分页, 每个根评论最多带reply_size条回复, 其余回复由get_reply_page分页
+    :param comments: 按id排序的评论
+    :param after: 上一页最后一个根评论的id
+    """
+    size = size or settings.COMMENT_PAGE_SIZE
+    reply_size = reply_size or settings.COMMENT_REPLY_PAGE_SIZE
+    tree = build_comment_tree(comments)
+    roots = tree.get(None, [])
+    start = bisect.bisect_right([c.pk for c in roots], after) if after else 0
+    page_roots = roots[start:start + size]
+    threads = []
+    for root in page_roots:
+        thread = _thread(root, _thread_replies(tree, root), 0, reply_size)
+        threads.append(thread._replace(entries=[(root, 0)] + thread.entries))
+    next_after = page_roots[-1].pk if start + size < len(roots) else None
+    return CommentPage(threads, next_after)
+
+
+def get_reply_page(comments, root_id, start=0, size=None):
+    """
+    根评论的一页回复, 不包括根评论本身
+    :param start: 回复的起始位置
+    """
+    size = size or settings.COMMENT_REPLY_PAGE_SIZE
+    tree = build_comment_tree(comments)
+    root = next((c for c in tree.get(None, []) if c.pk == root_id), None)
+    if root is None:
+        return CommentPage([], None)
+    return CommentPage([_thread(root, _thread_replies(tree, root), start, size)], None)
+
 
 def send_comment_email(comment):
     site = get_current_site().domain
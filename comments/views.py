@@ -1,12 +1,21 @@
 # Create your views here.
+from urllib.parse import urlencode
+
 from django import forms
 from django.contrib.auth import get_user_model
-from django.http import HttpResponseRedirect
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseRedirect, JsonResponse
+from django.shortcuts import get_object_or_404
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.views import View
 from django.views.generic.edit import FormView
 
 from blog.models import Article
+from djangoblog.utils import cache, make_namespace_key
 from .forms import CommentForm
 from .models import Comment
+from .templatetags.comments_tags import get_comment_bodies
+from .utils import get_comment_page, get_reply_page
 
 
 class CommentPostView(FormView):
@@ -66,3 +75,71 @@ class CommentPostView(FormView):
         return HttpResponseRedirect(
             "%s#div-comment-%d" %
             (article.get_absolute_url(), comment.pk))
+
+
+class CommentPageView(View):
+    """
+    文章评论的一页, 按根评论id分页; 带root参数时为该根评论的一页回复.
+    默认返回html片段, format=json时返回json. 结果缓存在文章评论的命名空间下
+    """
+
+    def get(self, request, *args, **kwargs):
+        article = get_object_or_404(Article, pk=self.kwargs['article_id'], status='p')
+        if article.comment_status != 'o':
+            raise Http404
+        try:
+            after, root, start = [int(request.GET.get(name, 0)) for name in ('after', 'root', 'start')]
+        except ValueError:
+            return HttpResponseBadRequest()
+        is_json = request.GET.get('format') == 'json'
+        key = make_namespace_key(
+            [article.comments_namespace()],
+            'comment_page_{id}_{after}_{root}_{start}_{format}'.format(
+                id=article.id, after=after, root=root, start=start, format=int(is_json)))
+        value = cache.get(key)
+        if value is None:
+            comments = article.comment_list()
+            if root:
+                page = get_reply_page(comments, root, start)
+            else:
+                page = get_comment_page(comments, after)
+            if is_json:
+                value = self.page_json(article, page, root)
+            else:
+                value = render_to_string('comments/tags/comment_page.html', {
+                    'article': article,
+                    'comment_page': page
+                })
+            cache.set(key, value, 36000)
+        if is_json:
+            return JsonResponse(value)
+        return HttpResponse(value)
+
+    @staticmethod
+    def page_url(article, **params):
+        return '{url}?{query}'.format(
+            url=reverse('comments:comment_page', kwargs={'article_id': article.id}),
+            query=urlencode(dict(params, format='json')))
+
+    def page_json(self, article, page, root):
+        bodies = get_comment_bodies(page.comments)
+        more_replies = {
+            thread.root.pk: self.page_url(article, root=thread.root.pk, start=thread.more_start)
+            for thread in page.threads if thread.more_start}
+        next_url = None
+        if page.next_after:
+            next_url = self.page_url(article, after=page.next_after)
+        elif root and page.threads and page.threads[0].more_start:
+            next_url = self.page_url(article, root=root, start=page.threads[0].more_start)
+        return {
+            'comments': [{
+                'id': comment.pk,
+                'parent_id': comment.parent_comment_id,
+                'depth': depth,
+                'author': comment.author.username,
+                'created_time': comment.created_time,
+                'body': bodies[comment.pk],
+                'more_replies': more_replies.get(comment.pk)
+            } for comment, depth in page.entries],
+            'next': next_url
+        }
@@ -1,19 +1,23 @@
-import _thread
 import logging
+import threading
 
 import django.dispatch
 from django.conf import settings
 from django.contrib.admin.models import LogEntry
 from django.contrib.auth.signals import user_logged_in, user_logged_out
 from django.core.mail import EmailMultiAlternatives
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
 from django.dispatch import receiver
 
 from djangoblog.spider_notify import SpiderNotify
-from djangoblog.utils import cache, expire_view_cache, delete_sidebar_cache, delete_view_cache
+from djangoblog.utils import delete_sidebar_cache
+from djangoblog.utils import bump_model_namespaces, bump_namespace
 from djangoblog.utils import get_current_site
+from blog.indexes import update_archive_index
+from blog.models import Article, Tag
 from comments.models import Comment
-from comments.utils import send_comment_email
+from comments.utils import invalidate_comment_caches, send_comment_email
 from oauth.models import OAuthUser
 
 logger = logging.getLogger(__name__)
@@ -73,44 +77,82 @@ def model_post_save_callback(
         using,
         update_fields,
         **kwargs):
-    clearcache = False
-    if isinstance(instance, LogEntry):
+    if isinstance(instance, (LogEntry, Comment)):
         return
+    is_update_views = update_fields == {'views'}
     if 'get_full_url' in dir(instance):
-        is_update_views = update_fields == {'views'}
         if not settings.TESTING and not is_update_views:
             try:
                 notify_url = instance.get_full_url()
                 SpiderNotify.baidu_notify([notify_url])
             except Exception as ex:
                 logger.error("notify sipder", ex)
-        if not is_update_views:
-            clearcache = True
-
-    if isinstance(instance, Comment):
-
-        path = instance.article.get_absolute_url()
-        site = get_current_site().domain
-        if site.find(':') > 0:
-            site = site[:site.find(':')]
-
-        expire_view_cache(
-            path,
-            servername=site,
-            serverport=80,
-            key_prefix='blogdetail')
-        if cache.get('seo_processor'):
-            cache.delete('seo_processor')
-        comment_cache_key = 'article_comments_{id}'.format(
-            id=instance.article.id)
-        cache.delete(comment_cache_key)
+
+    if isinstance(instance, Article) and not is_update_views:
+        # 文章状态可能变化
+        update_tag_counts(instance.tags.values_list('id', flat=True))
+        update_archive_index(instance)
+        if instance.list_key() != getattr(instance, '_loaded_list_key', None):
+            bump_namespace('article_list')
+            instance._loaded_list_key = instance.list_key()
+
+    if not is_update_views:
+        bump_model_namespaces(instance)
+
+
+def update_tag_counts(tag_ids):
+    if Tag.update_article_counts(tag_ids):
+        bump_namespace('tag')
         delete_sidebar_cache()
-        delete_view_cache('article_comments', [str(instance.article.pk)])
 
-        _thread.start_new(send_comment_email, (instance,))
 
-    if clearcache:
-        cache.clear()
+@receiver(m2m_changed, sender=Article.tags.through)
+def article_tags_changed_callback(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear':
+        # 清空后无法再查到原来的关联
+        if reverse:
+            instance._cleared_tag_ids = [instance.pk]
+        else:
+            instance._cleared_tag_ids = list(instance.tags.values_list('id', flat=True))
+    elif action == 'post_clear':
+        update_tag_counts(getattr(instance, '_cleared_tag_ids', []))
+        bump_namespace('article_list')
+    elif action in ('post_add', 'post_remove'):
+        update_tag_counts([instance.pk] if reverse else pk_set)
+        bump_namespace('article_list')
+
+
+@receiver(pre_delete, sender=Article)
+def article_pre_delete_callback(sender, instance, **kwargs):
+    instance._deleted_tag_ids = list(instance.tags.values_list('id', flat=True))
+
+
+@receiver(post_delete)
+def model_post_delete_callback(sender, instance, using, **kwargs):
+    if isinstance(instance, (LogEntry, Comment)):
+        return
+    if isinstance(instance, Article):
+        update_tag_counts(getattr(instance, '_deleted_tag_ids', []))
+        update_archive_index(instance, deleted=True)
+        bump_namespace('article_list')
+    bump_model_namespaces(instance)
+
+
+@receiver(post_save, sender=Comment)
+def comment_post_save_callback(sender, instance, created, **kwargs):
+    # 评论只影响所在文章的评论片段、评论数与侧边栏最新评论
+    invalidate_comment_caches([instance.article_id])
+    if created:
+        # 事务提交后再发送, 邮件中的链接才能看到评论
+        transaction.on_commit(lambda: threading.Thread(
+            target=send_comment_email, args=(instance,),
+            name='send_comment_email', daemon=True).start())
+
+
+@receiver(post_delete, sender=Comment)
+def comment_post_delete_callback(sender, instance, **kwargs):
+    # 随文章删除时更新不到任何文章
+    invalidate_comment_caches([instance.article_id])
 
 
 @receiver(user_logged_in)
@@ -4,7 +4,6 @@ from django.contrib.auth import get_user_model
 from django.contrib.syndication.views import Feed
 from django.utils.feedgenerator import Rss201rev2Feed
 
-from djangoblog.utils import CommonMarkdown
 from blog.models import Article
 
 
@@ -28,7 +27,7 @@ class DjangoBlogFeed(Feed):
         return item.title
 
     def item_description(self, item):
-        return CommonMarkdown.get_markdown(item.body)
+        return item.body_html
 
     def feed_copyright(self):
         now = datetime.now()
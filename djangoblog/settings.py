@@ -191,6 +191,14 @@ BOOTSTRAP_COLOR_TYPES = [
 
 # paginate
 PAGINATE_BY = 10
+# article lists seek by (article_order, pub_time, id) instead of COUNT(*) and OFFSET
+KEYSET_PAGINATION = env.bool('DJANGO_KEYSET_PAGINATION', default=True)
+# root comment threads per page on article pages and the comment page endpoint
+COMMENT_PAGE_SIZE = 20
+# replies shown under each root comment, the rest load with a 'more replies' link
+COMMENT_REPLY_PAGE_SIZE = 10
+# deeper replies are indented at this level
+COMMENT_MAX_DEPTH = 1
 # http cache timeout
 CACHE_CONTROL_MAX_AGE = 2592000
 # cache setting
@@ -202,6 +210,32 @@ CACHES = {
     }
 }
 
+# per-worker cache in front of CACHES for hot keys such as blog settings
+LOCAL_CACHE_SIZE = 256
+LOCAL_CACHE_MAX_BYTES = 4 * 1024 * 1024
+LOCAL_CACHE_TIMEOUT = 60
+# seconds a worker trusts its copy of the namespace versions
+LOCAL_CACHE_VERSION_INTERVAL = 1
+# cache_decorator: also lock through CACHES so only one worker recomputes an expired key
+CACHE_DECORATOR_DISTRIBUTED_LOCK = env.bool('DJANGO_CACHE_DECORATOR_DISTRIBUTED_LOCK', False)
+# code highlight cache: in-process LRU entries, optionally shared through CACHES
+HIGHLIGHT_CACHE_SIZE = 512
+HIGHLIGHT_CACHE_SHARED = env.bool('DJANGO_HIGHLIGHT_CACHE_SHARED', False)
+HIGHLIGHT_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+# article views are counted in the cache and written to the database every N seconds,
+# at most this window of counts is lost if the cache goes away
+VIEW_COUNT_FLUSH_INTERVAL = env.int('DJANGO_VIEW_COUNT_FLUSH_INTERVAL', default=60)
+# repeat views of an article from the same ip and user agent within this window count once
+VIEW_DEDUPE_WINDOW = 60 * 30
+# bloom filter per article and window, sized for this many visitors at this false positive rate
+# (5000 at 1% is ~6KB). A full filter is replaced by an empty one, so the rate stays bounded
+VIEW_DEDUPE_CAPACITY = env.int('DJANGO_VIEW_DEDUPE_CAPACITY', default=5000)
+VIEW_DEDUPE_ERROR_RATE = 0.01
+# length of the most read / trending rankings kept in the cache
+MOST_READ_SIZE = 20
+# trending ranking: a view counts half as much after this many seconds
+TRENDING_HALF_LIFE = 60 * 60 * 24
+
 SITE_ID = 1
 BAIDU_NOTIFY_URL = os.environ.get('DJANGO_BAIDU_NOTIFY_URL') \
                    or 'http://data.zz.baidu.com/urls?site=https://www.lylinux.net&token=1uAOGrMsUm5syDGn'
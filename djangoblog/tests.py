@@ -1,6 +1,7 @@
 from django.test import TestCase
 
 from djangoblog.utils import *
+from django.utils.html import strip_tags
 
 
 class DjangoBlogTest(TestCase):
@@ -24,9 +25,223 @@ class DjangoBlogTest(TestCase):
 
         ''')
         self.assertIsNotNone(c)
+        body, toc = CommonMarkdown.get_markdown_with_toc('# Title2')
+        self.assertIn('Title2', toc)
+        body, toc = CommonMarkdown.get_markdown_with_toc('no title[^1]\n\n[^1]: note')
+        self.assertNotIn('Title2', toc)
+        body = CommonMarkdown.get_markdown('plain text')
+        self.assertNotIn('note', body)
+        bodies = CommonMarkdown.get_markdown_batch(['*a*', '**b**', '*a*'])
+        self.assertEqual(3, len(bodies))
+        self.assertEqual(bodies[0], bodies[2])
+        self.assertIn('<strong>b</strong>', bodies[1])
+        # 缩写定义不能带到之后渲染的文档
+        CommonMarkdown.get_markdown('*[HTML]: Injected title\n\nhello')
+        self.assertNotIn('<abbr', CommonMarkdown.get_markdown('An HTML article'))
+        bodies = CommonMarkdown.get_markdown_batch(['*[word]: evil\n\nx', 'a word here'])
+        self.assertNotIn('<abbr', bodies[1])
+        self.assertIn('<abbr', CommonMarkdown.get_markdown('*[word]: ok\n\na word'))
+        value = '\n\n'.join(['paragraph [link][1] %d ' % i * 5 for i in range(50)])
+        value = '```python\nimport os\n\nimport re\n```\n\n' + value + '\n\n[1]: https://www.lylinux.net/'
+        source, is_full = CommonMarkdown._summary_source(value, 100)
+        self.assertFalse(is_full)
+        self.assertIn('import re', source)
+        self.assertIn('[1]: https://www.lylinux.net/', source)
+        self.assertNotIn('paragraph [link][1] 49', source)
+        summary = CommonMarkdown.get_markdown_summary(value, 100)
+        self.assertIn('href="https://www.lylinux.net/"', summary)
+        self.assertLessEqual(len(strip_tags(summary)), 100)
+        self.assertEqual(
+            CommonMarkdown.get_markdown_summary('short', 100),
+            CommonMarkdown.get_markdown('short'))
+        highlight_cache.clear()
+        code = '```python\nimport os\n```'
+        hits = highlight_cache.stats['hits']
+        misses = highlight_cache.stats['misses']
+        first = CommonMarkdown.get_markdown(code)
+        second = CommonMarkdown.get_markdown('text\n\n' + code)
+        self.assertEqual(highlight_cache.stats['misses'], misses + 1)
+        self.assertEqual(highlight_cache.stats['hits'], hits + 1)
+        self.assertIn(first, second)
+        CommonMarkdown.get_markdown('```javascript\nimport os\n```')
+        self.assertEqual(highlight_cache.stats['misses'], misses + 2)
+
+        lru = HighlightCache(2, shared=True)
+        lru.set('a', '1')
+        lru.set('b', '2')
+        lru.set('c', '3')
+        lru.clear()
+        self.assertEqual(lru.get('a'), '1')
+        self.assertEqual(lru.stats['shared_hits'], 1)
         d = {
             'd': 'key1',
             'd2': 'key2'
         }
         data = parse_dict_to_url(d)
         self.assertIsNotNone(data)
+
+    def test_model_namespaces(self):
+        from blog.models import Tag
+        tag = Tag()
+        tag.name = 'dependency'
+        tag.save()
+        namespaces = {
+            'tag_any': ['tag'],
+            'tag_self': ['tag:%d' % tag.pk],
+            'tag_other': ['tag:%d' % (tag.pk + 1)],
+            'category_any': ['category']}
+        for key, key_namespaces in namespaces.items():
+            cache.set(make_namespace_key(key_namespaces, key), 1)
+        stats = dict(namespace_bump_stats.get('blog.tag', {'saves': 0, 'namespaces': 0}))
+        bump_model_namespaces(tag)
+        values = {key: cache.get(make_namespace_key(key_namespaces, key))
+                  for key, key_namespaces in namespaces.items()}
+        self.assertEqual(values, {
+            'tag_any': None, 'tag_self': None, 'tag_other': 1, 'category_any': 1})
+        self.assertEqual(namespace_bump_stats['blog.tag'], {
+            'saves': stats['saves'] + 1, 'namespaces': stats['namespaces'] + 2})
+        # 没有缓存的实例只计保存次数
+        tag.pk += 1000
+        bump_model_namespaces(tag)
+        self.assertEqual(namespace_bump_stats['blog.tag'], {
+            'saves': stats['saves'] + 2, 'namespaces': stats['namespaces'] + 3})
+
+    def test_cache_namespaces(self):
+        key = make_namespace_key(['sidebar', 'article:1'], 'key')
+        # 版本号在进程内缓存, 再次生成key时不访问缓存服务
+        from unittest import mock
+        with mock.patch.object(cache, 'get_many', wraps=cache.get_many) as get_many:
+            self.assertEqual(key, make_namespace_key(['sidebar', 'article:1'], 'key'))
+        self.assertEqual(get_many.call_count, 0)
+        cache.set(key, 1)
+        bump_namespace('article:2')
+        self.assertEqual(cache.get(make_namespace_key(['sidebar', 'article:1'], 'key')), 1)
+        bump_namespace('sidebar')
+        self.assertIsNone(cache.get(make_namespace_key(['sidebar', 'article:1'], 'key')))
+        self.assertIsNone(bump_namespace('unknown_namespace'))
+
+        from blog.models import Tag
+        tag = Tag()
+        tag.name = 'namespace'
+        tag.save()
+        calls = []
+
+        @cache_decorator(namespaces=['tag:{0.pk}'])
+        def tag_name(t):
+            calls.append(t.pk)
+            return t.name
+
+        self.assertEqual(tag_name(tag), 'namespace')
+        self.assertEqual(tag_name(tag), 'namespace')
+        self.assertEqual(len(calls), 1)
+        tag.save()
+        self.assertEqual(tag_name(tag), 'namespace')
+        self.assertEqual(len(calls), 2)
+
+    def test_cache_stampede(self):
+        calls = []
+
+        @cache_decorator(60, beta=0)
+        def slow(n):
+            calls.append(n)
+            time.sleep(0.2)
+            return n * 2
+
+        barrier = threading.Barrier(100)
+        results = []
+
+        def worker():
+            barrier.wait()
+            results.append(slow(21))
+
+        threads = [threading.Thread(target=worker) for _ in range(100)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, [42] * 100)
+        self.assertEqual(len(calls), 1)
+
+        @cache_decorator(1, stale=60, beta=0)
+        def stale_value(n):
+            calls.append(n)
+            time.sleep(0.2)
+            return len(calls)
+
+        calls.clear()
+        self.assertEqual(stale_value(1), 1)
+        # 等待过期, 进入可返回旧值的时间段
+        time.sleep(1.1)
+        barrier = threading.Barrier(100)
+        results.clear()
+
+        def stale_worker():
+            barrier.wait()
+            results.append(stale_value(1))
+
+        threads = [threading.Thread(target=stale_worker) for _ in range(100)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(results.count(1), 99)
+        self.assertEqual(stale_value(1), 2)
+
+    def test_two_tier_cache(self):
+        two_tier = TwoTierCache(2, 1024, 60, 60)
+        two_tier.set('two_tier_a', 'a', namespaces=['two_tier'])
+        self.assertEqual(two_tier.get('two_tier_a', ['two_tier']), 'a')
+        self.assertEqual(two_tier.stats['local_hits'], 1)
+        # 其他worker写入的值从二级缓存读取
+        cache.set('two_tier_b', 'b')
+        self.assertEqual(two_tier.get('two_tier_b'), 'b')
+        self.assertEqual(two_tier.get('two_tier_b'), 'b')
+        self.assertEqual(two_tier.stats['shared_hits'], 1)
+        self.assertEqual(two_tier.stats['local_hits'], 2)
+        self.assertEqual(two_tier.hit_ratio()['local'], 2 / 3)
+
+        # 条数超限时淘汰最久未使用的key
+        two_tier.set('two_tier_c', 'c')
+        self.assertNotIn('two_tier_a', two_tier._data)
+        two_tier.set('two_tier_big', 'x' * 2048)
+        self.assertNotIn('two_tier_big', two_tier._data)
+
+        # 其他worker增加命名空间版本号后一级缓存失效
+        two_tier.set('two_tier_a', 'a', namespaces=['two_tier'])
+        cache.incr(namespace_version_key('two_tier'))
+        self.assertEqual(two_tier.get('two_tier_a', ['two_tier']), 'a')
+        two_tier.forget_namespace('two_tier')
+        # 二级缓存的key同样带版本号, 旧版本的值不再可见
+        self.assertIsNone(two_tier.get('two_tier_a', ['two_tier']))
+        cache.set(make_namespace_key(['two_tier'], 'two_tier_a'), 'a2')
+        self.assertEqual(two_tier.get('two_tier_a', ['two_tier']), 'a2')
+
+        from blog.models import BlogSettings
+        setting = get_blog_setting()
+        setting.sitename = 'two_tier_site'
+        setting.save()
+        self.assertEqual(get_blog_setting().sitename, 'two_tier_site')
+        hits = local_cache.stats['local_hits']
+        get_blog_setting()
+        self.assertEqual(local_cache.stats['local_hits'], hits + 1)
+        self.assertEqual(BlogSettings.objects.count(), 1)
+
+    def test_make_cache_key(self):
+        from blog.models import Tag
+        tag1 = Tag(pk=1, name='same')
+        tag2 = Tag(pk=2, name='same')
+
+        def func(*args, **kwargs):
+            pass
+
+        key = make_cache_key(func, (tag1, 'a'), {'n': 1})
+        self.assertEqual(
+            key,
+            "djangoblog.tests.DjangoBlogTest.test_make_cache_key.<locals>.func(blog.tag:1,'a',n=1)")
+        self.assertNotEqual(key, make_cache_key(func, (tag2, 'a'), {'n': 1}))
+        tag1.name = 'renamed'
+        self.assertEqual(key, make_cache_key(func, (tag1, 'a'), {'n': 1}))
+        long_key = make_cache_key(func, ('a b' * 100,), {})
+        self.assertNotIn(' ', long_key)
+        self.assertLessEqual(len(long_key), 250)
@@ -3,15 +3,29 @@
 
 
 import logging
+import math
 import os
+import pickle
 import random
+import re
 import string
+import threading
+import time
 import uuid
+import weakref
+from collections import OrderedDict, deque
+from functools import wraps
 from hashlib import sha256
 
 import requests
+from django.conf import settings
 from django.contrib.sites.models import Site
 from django.core.cache import cache
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.db.models import Model
+from django.utils.html import strip_tags
+from django.utils.text import Truncator
+from markdown.extensions import codehilite
 
 logger = logging.getLogger(__name__)
 
@@ -27,8 +41,197 @@ def get_sha256(str):
     return m.hexdigest()
 
 
-def cache_decorator(expiration=3 * 60):
+def namespace_version_key(namespace):
+    return 'cache_namespace_' + namespace
+
+
+def get_namespace_versions(namespaces):
+    """
+    获得各命名空间当前的版本号
+    :return: {命名空间: 版本号}
+    """
+    keys = {namespace_version_key(n): n for n in namespaces}
+    found = cache.get_many(list(keys))
+    versions = {keys[k]: v for k, v in found.items()}
+    for key, namespace in keys.items():
+        if namespace not in versions:
+            # 以毫秒时间戳作为初始版本, 版本号被淘汰后重建也不会与旧版本重复
+            version = int(time.time() * 1000)
+            if not cache.add(key, version, None):
+                version = cache.get(key, version)
+            versions[namespace] = version
+    return versions
+
+
+def make_namespace_key(namespaces, key):
+    """
+    生成带命名空间版本号的key, 命名空间版本号增加后旧key自然失效
+    :param namespaces: 命名空间列表, 如['sidebar'], ['article:42']
+    :param key: 原始key
+    """
+    if not namespaces:
+        return key
+    # 版本号在进程内缓存, 不必每次都访问缓存服务
+    versions = local_cache.namespace_versions(namespaces)
+    return '{key}_v{versions}'.format(
+        key=key, versions='.'.join(str(v) for v in versions))
+
+
+def bump_namespace(namespace):
+    """
+    增加命名空间版本号, 使该命名空间下的所有key失效
+    """
+    local_cache.forget_namespace(namespace)
+    try:
+        return cache.incr(namespace_version_key(namespace))
+    except ValueError:
+        # 版本号不存在时, 命名空间下也不会有按当前版本缓存的key
+        return None
+
+
+def model_namespaces(instance):
+    """
+    模型实例对应的命名空间, 如'article'与'article:42'
+    """
+    name = instance._meta.model_name
+    return [name, '{name}:{pk}'.format(name=name, pk=instance.pk)]
+
+
+# 各模型保存或删除的次数及失效的命名空间数, 如{'blog.tag': {'saves': 3, 'namespaces': 5}}.
+# 命名空间没有版本号时其下没有缓存, 不计入失效数
+namespace_bump_stats = {}
+_namespace_bump_stats_lock = threading.Lock()
+
+
+def bump_model_namespaces(instance):
+    """
+    模型实例保存或删除后, 使该模型及实例的命名空间失效, 其下的缓存key随之失效
+    """
+    label = instance._meta.label_lower
+    bumped = sum(bump_namespace(namespace) is not None
+                 for namespace in model_namespaces(instance))
+    with _namespace_bump_stats_lock:
+        stats = namespace_bump_stats.setdefault(label, {'saves': 0, 'namespaces': 0})
+        stats['saves'] += 1
+        stats['namespaces'] += bumped
+    logger.info('bump {count} cache namespaces of {label}:{pk}'.format(
+        count=bumped, label=label, pk=instance.pk))
+
+
+# memcached不允许key中出现空白与控制字符, 且长度不超过250
+CACHE_KEY_MAX_LENGTH = 200
+_unsafe_key_re = re.compile(r'[\x00-\x20\x7f]')
+
+
+def _normalize_cache_arg(value):
+    """
+    将参数转为稳定的字符串, 模型实例使用label与主键, 与标题等可变字段无关
+    """
+    if isinstance(value, Model):
+        return '{label}:{pk}'.format(label=value._meta.label_lower, pk=value.pk)
+    if isinstance(value, (list, tuple)):
+        return '[' + ','.join(_normalize_cache_arg(v) for v in value) + ']'
+    if isinstance(value, dict):
+        return '{' + ','.join(
+            '{k}={v}'.format(k=k, v=_normalize_cache_arg(v))
+            for k, v in sorted(value.items())) + '}'
+    return repr(value)
+
+
+def make_cache_key(func, args, kwargs):
+    """
+    由函数的模块名与限定名及参数生成key, 不同进程、不同部署间保持一致.
+    参数较长或包含不能用作key的字符时才计算哈希
+    """
+    name = func.__module__ + '.' + func.__qualname__
+    params = ','.join([_normalize_cache_arg(a) for a in args] + [
+        '{k}={v}'.format(k=k, v=_normalize_cache_arg(v))
+        for k, v in sorted(kwargs.items())])
+    key = '{name}({params})'.format(name=name, params=params)
+    if len(key) > CACHE_KEY_MAX_LENGTH or _unsafe_key_re.search(key):
+        key = '{name}#{digest}'.format(name=name, digest=get_sha256(params))
+    return key
+
+
+# 进程内按key加锁, 同一key同时只有一个线程/greenlet计算
+_cache_locks = weakref.WeakValueDictionary()
+_cache_locks_guard = threading.Lock()
+
+
+def _get_cache_lock(key):
+    with _cache_locks_guard:
+        lock = _cache_locks.get(key)
+        if lock is None:
+            lock = threading.Lock()
+            _cache_locks[key] = lock
+        return lock
+
+
+def _should_refresh(expires_at, delta, beta):
+    """
+    概率提前过期: 越接近过期时间, 计算越慢, 越可能提前重新计算
+    """
+    now = time.time()
+    if now >= expires_at:
+        return True
+    if beta <= 0:
+        return False
+    return now - delta * beta * math.log(1.0 - random.random()) >= expires_at
+
+
+def cache_decorator(expiration=3 * 60, namespaces=(),
+                    stale=0, beta=1.0, distributed_lock=None):
+    """
+    :param expiration: 过期时间
+    :param namespaces: key所属的命名空间, 可使用参数格式化, 如'category:{0.category_id}'.
+        被装饰的是模型方法时自动属于该实例的命名空间
+    :param stale: 过期后仍可返回旧值的秒数, 期间只有一个调用者重新计算
+    :param beta: 概率提前过期系数, 0表示不提前
+    :param distributed_lock: 是否同时使用缓存锁, 多个worker之间也只计算一次,
+        默认取settings.CACHE_DECORATOR_DISTRIBUTED_LOCK
+    """
+    if distributed_lock is None:
+        distributed_lock = settings.CACHE_DECORATOR_DISTRIBUTED_LOCK
+
     def wrapper(func):
+        def unwrap(entry):
+            value = entry[0]
+            if str(value) == '__default_cache_value__':
+                return None
+            return value
+
+        def compute(key, args, kwargs):
+            logger.info(
+                'cache_decorator set cache:%s key:%s' %
+                (func.__name__, key))
+            start = time.time()
+            value = func(*args, **kwargs)
+            delta = time.time() - start
+            entry = (
+                '__default_cache_value__' if value is None else value,
+                time.time() + expiration,
+                delta)
+            cache.set(key, entry, expiration + stale)
+            return value
+
+        def compute_with_distributed_lock(key, args, kwargs):
+            lock_key = 'cache_lock_' + key
+            # 锁最长持有时间, 避免持有者异常退出后一直无法计算
+            lock_timeout = min(expiration, 60)
+            if cache.add(lock_key, 1, lock_timeout):
+                try:
+                    return compute(key, args, kwargs)
+                finally:
+                    cache.delete(lock_key)
+            # 其他worker正在计算, 等待其结果, 超时后自行计算
+            deadline = time.time() + lock_timeout
+            while time.time() < deadline:
+                time.sleep(0.05)
+                entry = cache.get(key)
+                if entry is not None:
+                    return unwrap(entry)
+            return compute(key, args, kwargs)
+
         def news(*args, **kwargs):
             try:
                 view = args[0]
@@ -36,77 +239,326 @@ def cache_decorator(expiration=3 * 60):
             except BaseException:
                 key = None
             if not key:
-                unique_str = repr((func, args, kwargs))
-
-                m = sha256(unique_str.encode('utf-8'))
-                key = m.hexdigest()
-            value = cache.get(key)
-            if value is not None:
-                # logger.info('cache_decorator get cache:%s key:%s' % (func.__name__, key))
-                if str(value) == '__default_cache_value__':
-                    return None
-                else:
-                    return value
-            else:
-                logger.info(
-                    'cache_decorator set cache:%s key:%s' %
-                    (func.__name__, key))
-                value = func(*args, **kwargs)
-                if value is None:
-                    cache.set(key, '__default_cache_value__', expiration)
-                else:
-                    cache.set(key, value, expiration)
-                return value
+                key = make_cache_key(func, args, kwargs)
+            key_namespaces = [n.format(*args, **kwargs) for n in namespaces]
+            if args and isinstance(args[0], Model):
+                key_namespaces.append(model_namespaces(args[0])[1])
+            key = make_namespace_key(key_namespaces, key)
+            entry = cache.get(key)
+            if entry is not None:
+                if not _should_refresh(entry[1], entry[2], beta):
+                    return unwrap(entry)
+                # 已有调用者在重新计算时, 直接返回旧值
+                lock = _get_cache_lock(key)
+                if not lock.acquire(blocking=False):
+                    return unwrap(entry)
+                try:
+                    fresh = cache.get(key)
+                    if fresh is not None and fresh[1] != entry[1]:
+                        return unwrap(fresh)
+                    return compute(key, args, kwargs)
+                finally:
+                    lock.release()
+
+            lock = _get_cache_lock(key)
+            with lock:
+                # 等待锁期间其他调用者可能已经算好
+                entry = cache.get(key)
+                if entry is not None and time.time() < entry[1]:
+                    return unwrap(entry)
+                if distributed_lock:
+                    return compute_with_distributed_lock(key, args, kwargs)
+                return compute(key, args, kwargs)
 
         return news
 
     return wrapper
 
 
-def expire_view_cache(path, servername, serverport, key_prefix=None):
+def cache_page_with_namespaces(timeout, namespaces):
     """
-    刷新视图缓存
-    :param path:url路径
-    :param servername:host
-    :param serverport:端口
-    :param key_prefix:前缀
-    :return:是否成功
+    与cache_page相同, 页面缓存key带命名空间版本号, 命名空间失效后页面缓存随之失效
     """
-    from django.http import HttpRequest
-    from django.utils.cache import get_cache_key
+    from django.views.decorators.cache import cache_page
 
-    request = HttpRequest()
-    request.META = {'SERVER_NAME': servername, 'SERVER_PORT': serverport}
-    request.path = path
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            key_prefix = make_namespace_key(list(namespaces), 'page')
+            return cache_page(timeout, key_prefix=key_prefix)(view_func)(
+                request, *args, **kwargs)
 
-    key = get_cache_key(request, key_prefix=key_prefix, cache=cache)
-    if key:
-        logger.info('expire_view_cache:get key:{path}'.format(path=path))
-        if cache.get(key):
-            cache.delete(key)
-        return True
-    return False
+        return wrapper
+
+    return decorator
+
+
+class TwoTierCache:
+    """
+    两级缓存: 进程内LRU为一级缓存, django cache为二级缓存.
+    一级缓存按条数与字节数限制大小, 并有较短的过期时间;
+    写入时记录所属命名空间的版本号, 版本号变化(如其他worker保存了模型)后一级缓存失效.
+    命名空间版本号在进程内缓存version_interval秒, 避免每次读取都访问缓存服务
+    """
+
+    def __init__(self, maxsize, maxbytes, timeout, version_interval):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.timeout = timeout
+        self.version_interval = version_interval
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._versions = {}
+        self._lock = threading.Lock()
+        self.stats = {'local_hits': 0, 'shared_hits': 0, 'misses': 0}
+
+    def hit_ratio(self):
+        """
+        :return: 各级缓存命中率
+        """
+        total = sum(self.stats.values())
+        if not total:
+            return {'local': 0.0, 'shared': 0.0}
+        return {
+            'local': self.stats['local_hits'] / total,
+            'shared': self.stats['shared_hits'] / total}
+
+    def namespace_versions(self, namespaces):
+        now = time.time()
+        versions = {}
+        expired = []
+        with self._lock:
+            for namespace in namespaces:
+                cached = self._versions.get(namespace)
+                if cached and now - cached[1] < self.version_interval:
+                    versions[namespace] = cached[0]
+                else:
+                    expired.append(namespace)
+        if expired:
+            found = get_namespace_versions(expired)
+            with self._lock:
+                for namespace, version in found.items():
+                    self._versions[namespace] = (version, now)
+            versions.update(found)
+        return tuple(versions[n] for n in namespaces)
+
+    def forget_namespace(self, namespace):
+        """本进程内命名空间版本号变化时立即生效"""
+        with self._lock:
+            self._versions.pop(namespace, None)
+
+    def get(self, key, namespaces=()):
+        versions = self.namespace_versions(namespaces)
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, entry_versions, expires_at, size = entry
+                if entry_versions == versions and time.time() < expires_at:
+                    self._data.move_to_end(key)
+                    self.stats['local_hits'] += 1
+                    return value
+                self._remove(key)
+        value = cache.get(self._shared_key(key, versions))
+        if value is None:
+            self.stats['misses'] += 1
+            return None
+        self.stats['shared_hits'] += 1
+        self._set_local(key, value, versions)
+        return value
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, namespaces=()):
+        versions = self.namespace_versions(namespaces)
+        cache.set(self._shared_key(key, versions), value, timeout)
+        self._set_local(key, value, versions)
+
+    def get_or_set(self, key, default, timeout=DEFAULT_TIMEOUT, namespaces=()):
+        value = self.get(key, namespaces)
+        if value is None:
+            value = default()
+            if value is not None:
+                self.set(key, value, timeout, namespaces)
+        return value
+
+    def delete(self, key, namespaces=()):
+        with self._lock:
+            self._remove(key)
+        cache.delete(self._shared_key(key, self.namespace_versions(namespaces)))
+
+    @staticmethod
+    def _shared_key(key, versions):
+        """二级缓存的key带命名空间版本号, 与make_namespace_key格式相同"""
+        if not versions:
+            return key
+        return '{key}_v{versions}'.format(
+            key=key, versions='.'.join(str(v) for v in versions))
+
+    def clear(self):
+        """只清空一级缓存"""
+        with self._lock:
+            self._data.clear()
+            self._versions.clear()
+            self._bytes = 0
+
+    def _remove(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[3]
+
+    def _set_local(self, key, value, versions):
+        try:
+            size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        except Exception:
+            return
+        if size > self.maxbytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._data[key] = (
+                value, versions, time.time() + self.timeout, size)
+            self._bytes += size
+            while len(self._data) > self.maxsize or self._bytes > self.maxbytes:
+                _, entry = self._data.popitem(last=False)
+                self._bytes -= entry[3]
+
+
+local_cache = TwoTierCache(
+    settings.LOCAL_CACHE_SIZE,
+    settings.LOCAL_CACHE_MAX_BYTES,
+    settings.LOCAL_CACHE_TIMEOUT,
+    settings.LOCAL_CACHE_VERSION_INTERVAL)
 
 
-@cache_decorator()
 def get_current_site():
-    return Site.objects.get_current()
+    return local_cache.get_or_set(
+        'get_current_site', Site.objects.get_current, namespaces=['site'])
+
+
+class HighlightCache:
+    """
+    代码高亮结果缓存, key由lexer、代码内容与格式化参数组成.
+    进程内LRU为一级缓存, 可选使用django cache作为共享的二级缓存
+    """
+
+    def __init__(self, maxsize, shared=False, shared_timeout=None):
+        self.maxsize = maxsize
+        self.shared = shared
+        self.shared_timeout = shared_timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'shared_hits': 0, 'misses': 0}
+
+    @staticmethod
+    def make_key(code, lexer, formatter):
+        unique_str = repr((
+            type(lexer).__name__, sorted(lexer.options.items()),
+            type(formatter).__name__, sorted(formatter.options.items())))
+        return 'highlight_' + get_sha256(unique_str + code)
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+                self.stats['hits'] += 1
+                return value
+        if self.shared:
+            value = cache.get(key)
+            if value is not None:
+                self.stats['shared_hits'] += 1
+                self._set_local(key, value)
+                return value
+        self.stats['misses'] += 1
+        return None
+
+    def set(self, key, value):
+        self._set_local(key, value)
+        if self.shared:
+            cache.set(key, value, self.shared_timeout)
+
+    def _set_local(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def highlight(self, code, lexer, formatter):
+        """与pygments.highlight参数一致"""
+        import pygments
+        key = self.make_key(code, lexer, formatter)
+        value = self.get(key)
+        if value is None:
+            value = pygments.highlight(code, lexer, formatter)
+            self.set(key, value)
+        return value
+
+
+highlight_cache = HighlightCache(
+    settings.HIGHLIGHT_CACHE_SIZE,
+    shared=settings.HIGHLIGHT_CACHE_SHARED,
+    shared_timeout=settings.HIGHLIGHT_CACHE_TIMEOUT)
+# codehilite(包括extra中的fenced_code)在调用时才查找模块内的highlight函数,
+# 导入时替换一次为带缓存的版本, 本进程内所有Markdown转换的代码高亮都经过缓存
+codehilite.highlight = highlight_cache.highlight
 
 
 class CommonMarkdown:
+    # 引用式链接的定义, 只渲染部分内容时需要保留
+    reference_re = re.compile(r'^ {0,3}\[(?!\^)[^\]]+\]:[ \t]*\S.*$', re.M)
+    extensions = [
+        'extra',
+        'codehilite',
+        'toc',
+        'tables',
+    ]
+    # 空闲转换器的最大数量
+    pool_size = 16
+    _pool = deque()
+
     @staticmethod
-    def _convert_markdown(value):
+    def _create_markdown():
         import markdown
-        md = markdown.Markdown(
-            extensions=[
-                'extra',
-                'codehilite',
-                'toc',
-                'tables',
-            ]
-        )
+        return markdown.Markdown(extensions=CommonMarkdown.extensions)
+
+    @staticmethod
+    def _acquire():
+        """
+        从池中取出一个转换器, 池为空时新建.
+        deque的pop/append是原子操作, 每个转换器同一时间只被一个线程或greenlet持有
+        """
+        try:
+            return CommonMarkdown._pool.pop()
+        except IndexError:
+            return CommonMarkdown._create_markdown()
+
+    @staticmethod
+    def _reset(md):
+        """
+        清除上一篇文档的状态. reset()不会移除abbr扩展按定义注册的行内规则,
+        不清除时缩写定义会带到之后渲染的文档中
+        """
+        md.reset()
+        for name in [item.name for item in md.inlinePatterns._priority
+                     if item.name.startswith('abbr-')]:
+            md.inlinePatterns.deregister(name)
+
+    @staticmethod
+    def _release(md):
+        CommonMarkdown._reset(md)
+        if len(CommonMarkdown._pool) < CommonMarkdown.pool_size:
+            CommonMarkdown._pool.append(md)
+
+    @staticmethod
+    def _convert_markdown(value):
+        md = CommonMarkdown._acquire()
         body = md.convert(value)
         toc = md.toc
+        # 转换出错时直接丢弃该转换器, 不放回池中
+        CommonMarkdown._release(md)
         return body, toc
 
     @staticmethod
@@ -119,6 +571,83 @@ class CommonMarkdown:
         body, toc = CommonMarkdown._convert_markdown(value)
         return body
 
+    @staticmethod
+    def get_markdown_batch(values):
+        """
+        批量转换, 复用同一个转换器, 相同内容只转换一次
+        :param values: markdown文本列表
+        :return: 与输入顺序一致的html列表
+        """
+        results = {}
+        md = CommonMarkdown._acquire()
+        for value in values:
+            if value not in results:
+                results[value] = md.convert(value)
+                CommonMarkdown._reset(md)
+        CommonMarkdown._release(md)
+        return [results[value] for value in values]
+
+    @staticmethod
+    def _split_blocks(value):
+        """
+        按空行拆分顶层块, 围栏代码块内的空行不拆分
+        """
+        blocks = []
+        lines = []
+        fence = None
+        for line in value.splitlines():
+            stripped = line.lstrip()
+            if fence:
+                if stripped.startswith(fence):
+                    fence = None
+            elif stripped.startswith('```') or stripped.startswith('~~~'):
+                fence = stripped[:3]
+            if line.strip() or fence:
+                lines.append(line)
+            elif lines:
+                blocks.append('\n'.join(lines))
+                lines = []
+        if lines:
+            blocks.append('\n'.join(lines))
+        return blocks
+
+    @staticmethod
+    def _summary_source(value, length):
+        """
+        取出达到摘要长度所需的前几个块
+        :return: (markdown文本, 是否为全文)
+        """
+        blocks = CommonMarkdown._split_blocks(value)
+        size = 0
+        for index, block in enumerate(blocks[:-1]):
+            size += len(block)
+            if size >= length:
+                references = CommonMarkdown.reference_re.findall(value)
+                return '\n\n'.join(blocks[:index + 1] + references), False
+        return value, True
+
+    @staticmethod
+    def get_markdown_summary_batch(values, length):
+        """
+        批量生成摘要, 只渲染前面足够长度的块再按html截断
+        :param values: markdown文本列表
+        :param length: 摘要长度
+        :return: 与输入顺序一致的摘要html列表
+        """
+        sources = [CommonMarkdown._summary_source(v, length) for v in values]
+        bodies = CommonMarkdown.get_markdown_batch([s for s, _ in sources])
+        summaries = []
+        for value, (source, is_full), body in zip(values, sources, bodies):
+            if not is_full and len(strip_tags(body)) < length:
+                # 标记较多时渲染后的文本偏短, 改为渲染全文
+                body = CommonMarkdown.get_markdown(value)
+            summaries.append(Truncator(body).chars(length, html=True))
+        return summaries
+
+    @staticmethod
+    def get_markdown_summary(value, length):
+        return CommonMarkdown.get_markdown_summary_batch([value], length)[0]
+
 
 def send_email(emailto, title, content):
     from djangoblog.blog_signals import send_email_signal
@@ -140,7 +669,7 @@ def parse_dict_to_url(dict):
 
 
 def get_blog_setting():
-    value = cache.get('get_blog_setting')
+    value = local_cache.get('get_blog_setting', ['blogsettings'])
     if value:
         return value
     else:
@@ -162,7 +691,9 @@ def get_blog_setting():
             setting.save()
         value = BlogSettings.objects.first()
         logger.info('set cache get_blog_setting')
-        cache.set('get_blog_setting', value)
+        local_cache.set(
+            'get_blog_setting', value,
+            namespaces=['blogsettings'])
         return value
 
 
@@ -203,14 +734,5 @@ def save_user_avatar(url):
 
 
 def delete_sidebar_cache():
-    from blog.models import LinkShowType
-    keys = ["sidebar" + x for x in LinkShowType.values]
-    for k in keys:
-        logger.info('delete sidebar key:' + k)
-        cache.delete(k)
-
-
-def delete_view_cache(prefix, keys):
-    from django.core.cache.utils import make_template_fragment_key
-    key = make_template_fragment_key(prefix, keys)
-    cache.delete(key)
+    logger.info('delete sidebar cache')
+    bump_namespace('sidebar')
@@ -30,13 +30,12 @@ tuling = TuLing()
 
 def convert_to_articlereply(articles, message):
     reply = ArticlesReply(message=message)
-    from blog.templatetags.blog_tags import truncatechars_content
     for post in articles:
         imgs = re.findall(r'(?:http\:|https\:)?\/\/.*\.(?:png|jpg)', post.body)
         imgurl = imgs[0] if imgs else ''
         article = Article(
             title=post.title,
-            description=truncatechars_content(post.body),
+            description=post.excerpt,
             img=imgurl,
             url=post.get_full_url()
         )